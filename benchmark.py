@@ -0,0 +1,246 @@
+"""
+Offline CPU benchmark suite of the training pipeline.
+Generates synthetic Zipfian corpora with vocabularies, times the pipeline stages across vocabulary sizes,
+dimensions and batch sizes, writes the results as JSON and compares them against a stored baseline.
+
+    python benchmark.py --update_baseline    # store results as the baseline of this host
+    python benchmark.py                      # quick grid, compare with benchmarks/baseline.json
+    python benchmark.py --grid full -o results.json --no_compare
+
+No baseline is committed, timings are comparable only on the host they were measured on,
+so a missing baseline is an error unless --no_compare is given.
+"""
+import os
+
+os.environ["CUDA_VISIBLE_DEVICES"] = ""
+
+import argparse
+import itertools
+import json
+import logging
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from cbow import CBOW, WordContextDataProcessor, init_argparser_cbow
+from evaluation.analogy_questions.analogy_questions import eval_analogy_questions
+from evaluation.intrinstric_evaluation.wordsim.wordsim import Wordsim
+from skipgram import Skipgram, WordTargetDataProcessor, init_argparser_skipgram
+from vocab import write_frequency_vocab
+from word2vec import init_argparser_general
+
+DEFAULT_BASELINE = os.path.join("benchmarks", "baseline.json")
+
+GRIDS = {
+    "quick": dict(vocab_size=[10000], dimension=[100], batch_size=[512]),
+    "full": dict(vocab_size=[10000, 100000], dimension=[100, 300], batch_size=[512, 4096])
+}
+# Tokens of the synthetic corpus per word of the vocabulary, at least MIN_TOKENS
+TOKENS_PER_WORD = 20
+MIN_TOKENS = 500000
+
+
+def synthetic_words(vocab_size):
+    """
+    Words of the wordsim datasets come first (so wordsim evaluation finds them), synthetic words fill the rest.
+    """
+    words = sorted({w for data in Wordsim("en").dataset.values() for datum in data for w in datum[:2]})
+    words = words[:vocab_size]
+    return words + [f"w{i}" for i in range(vocab_size - len(words))]
+
+
+def generate_corpus(directory, vocab_size, seed=0, exponent=1.0):
+    """
+    Writes corpus of words drawn from Zipfian distribution, its frequency vocabulary
+    and analogy questions file made of random words.
+    :return: tuple of paths (corpus, vocabulary, analogy questions)
+    """
+    rng = np.random.RandomState(seed)
+    words = np.array(synthetic_words(vocab_size))
+    probs = 1. / np.arange(1, vocab_size + 1) ** exponent
+    tokens = rng.choice(vocab_size, size=max(vocab_size * TOKENS_PER_WORD, MIN_TOKENS), p=probs / probs.sum())
+
+    corpus = os.path.join(directory, f"zipf_{vocab_size}.txt")
+    with open(corpus, "w", encoding="utf-8") as f:
+        for line in np.array_split(words[tokens], len(tokens) // 1000):
+            f.write(" ".join(line) + "\n")
+
+    counts = np.bincount(tokens, minlength=vocab_size)
+    vocab = os.path.join(directory, f"zipf_{vocab_size}.vocab")
+    write_frequency_vocab({words[i]: int(counts[i]) for i in np.argsort(-counts, kind="stable") if counts[i]}, vocab)
+
+    analogies = os.path.join(directory, f"zipf_{vocab_size}.analogies")
+    with open(analogies, "w", encoding="utf-8") as f:
+        for section in range(4):
+            f.write(f": section-{section}\n")
+            for question in rng.choice(min(vocab_size, 5000), size=(500, 4)):
+                f.write(" ".join(words[question]) + "\n")
+    return corpus, vocab, analogies
+
+
+def create_args(init_argparser_model, corpus, vocab, analogies, dimension, batch_size, extra=()):
+    parser = argparse.ArgumentParser()
+    init_argparser_general(parser)
+    init_argparser_model(parser)
+    # Periodic validation is disabled, the evaluators are timed separately
+    never = str(sys.maxsize)
+    return parser.parse_args(["-c", corpus, "--vocab", vocab, "--eval_aq", analogies, "-d", str(dimension),
+                              "-bs", str(batch_size), "-mf", "1",
+                              "--lossreport_step", never, "--epoch_state_step", never, "--eval_aq_step", never,
+                              "--eval_intrx_step", never, "--sanity_check_step", never, "--eval_extrx_step", never,
+                              "--visdom_step", never, "--tensorboard_step", never, *extra])
+
+
+def measure(fn, repeat=5, number=1):
+    """
+    :return: median of repeat measurements of seconds per call of fn, each measurement calls fn number times
+    """
+    fn()  # warm up
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - t) / number)
+    return statistics.median(times)
+
+
+def measure_batch_gen(data_proc, batches):
+    """
+    :return: seconds per batch created by data_proc.create_batch_gen
+    """
+    data_proc.init_benchmark()
+    t = time.perf_counter()
+    n = sum(1 for _ in itertools.islice(data_proc.create_batch_gen(), batches))
+    return (time.perf_counter() - t) / max(n, 1)
+
+
+def benchmark_config(directory, corpus_files, vocab_size, dimension, batch_size, repeat):
+    """
+    :return: list of results of all benchmarks with given parameters
+    """
+    params = dict(vocab_size=vocab_size, dimension=dimension, batch_size=batch_size)
+    results = []
+
+    def record(name, seconds, items=None, unit=None):
+        result = dict(name=name, params=params, seconds=seconds)
+        if items is not None:
+            result["throughput"] = items / seconds
+            result["unit"] = f"{unit}/s"
+        results.append(result)
+        logging.info(f"{name} {params}: {seconds * 1e3:.3f} ms"
+                     + (f", {items / seconds:.0f} {unit}/s" if items is not None else ""))
+
+    for name, processor_cls, model_cls, init_argparser_model in (
+            ("skipgram", WordTargetDataProcessor, Skipgram, init_argparser_skipgram),
+            ("cbow", WordContextDataProcessor, CBOW, init_argparser_cbow)):
+        args = create_args(init_argparser_model, *corpus_files, dimension, batch_size)
+        data_proc = processor_cls(args, name)
+        model = model_cls(data_proc)
+
+        if name == "skipgram":
+            # Negative sampler setup replaced the former init_sample_table
+            record("init_neg_sampler", measure(data_proc.init_neg_sampler, repeat=repeat))
+            record("get_neg_v_neg_sampling", measure(data_proc.get_neg_v_neg_sampling, repeat=repeat, number=20),
+                   batch_size * data_proc.nsamples, "samples")
+
+        record(f"create_batch_gen_{name}", measure_batch_gen(data_proc, 200), batch_size, "pairs")
+
+        data_proc.init_benchmark()
+        batches = list(itertools.islice(data_proc.create_batch_gen(), 20))
+        batch_iter = itertools.cycle(batches)
+        record(f"forward_backward_{name}", measure(lambda: model.train_step(next(batch_iter)), repeat=repeat,
+                                                   number=len(batches)), batch_size, "pairs")
+
+        if name == "skipgram":
+            path = os.path.join(directory, "embeddings.vec")
+            record("save_vec", measure(lambda: model.save(path), repeat=min(repeat, 3)), vocab_size, "words")
+            record("eval_analogy_questions",
+                   measure(lambda: eval_analogy_questions(data_proc, model.u_embeddings),
+                           repeat=repeat), len(data_proc.analogy_questions), "questions")
+            record("eval_wordsim", measure(model.intristric_eval, repeat=repeat))
+        data_proc.__exit__(None, None, None)
+    return results
+
+
+def result_key(result):
+    return result["name"] + json.dumps(result["params"], sort_keys=True)
+
+
+def compare(results, baseline, tolerance):
+    """
+    Logs relative change of each benchmark against the baseline.
+    :return: list of keys of benchmarks slower than baseline by more than tolerance
+    """
+    baseline = {result_key(r): r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        key = result_key(result)
+        if key not in baseline:
+            continue
+        ratio = result["seconds"] / baseline[key]["seconds"]
+        status = "REGRESSION" if ratio > 1. + tolerance else "ok"
+        if status != "ok":
+            regressions.append(key)
+        logging.info(f"{status:>10} {ratio:6.2f}x {key}")
+    return regressions
+
+
+def run(grid, repeat, seed):
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for vocab_size in grid["vocab_size"]:
+            corpus_files = generate_corpus(directory, vocab_size, seed=seed)
+            for dimension, batch_size in itertools.product(grid["dimension"], grid["batch_size"]):
+                np.random.seed(seed)
+                torch.manual_seed(seed)
+                results.extend(benchmark_config(directory, corpus_files, vocab_size, dimension, batch_size, repeat))
+    return {
+        "meta": dict(time=time.time(), host=platform.node(), python=platform.python_version(),
+                     numpy=np.__version__, torch=torch.__version__, threads=torch.get_num_threads()),
+        "results": results
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline CPU benchmarks of the training pipeline")
+    parser.add_argument("--grid", choices=list(GRIDS), default="quick")
+    parser.add_argument("--repeat", help="measurements per benchmark, median is reported", default=5)
+    parser.add_argument("--seed", default=0)
+    parser.add_argument("-o", "--output", help="where to write results", default="benchmark_results.json")
+    parser.add_argument("--baseline", help="results to compare with", default=DEFAULT_BASELINE)
+    parser.add_argument("--tolerance", help="allowed relative slowdown against baseline", default=0.2)
+    parser.add_argument("--update_baseline", help="store results as the baseline", action="store_true")
+    parser.add_argument("--no_compare", help="only measure, do not compare with baseline", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
+
+    results = run(GRIDS[args.grid], int(args.repeat), int(args.seed))
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    logging.info(f"Results written to {args.output}")
+
+    if args.update_baseline:
+        os.makedirs(os.path.dirname(args.baseline) or ".", exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        logging.info(f"Baseline updated in {args.baseline}")
+    elif not args.no_compare:
+        if not os.path.exists(args.baseline):
+            logging.error(f"Baseline {args.baseline} does not exist, nothing was compared. Store one measured "
+                          f"on this host with --update_baseline, or pass --no_compare.")
+            sys.exit(1)
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["meta"]["host"] != results["meta"]["host"]:
+            logging.warning(f"Baseline was measured on {baseline['meta']['host']}, "
+                            f"timings of different hosts are not comparable")
+        regressions = compare(results["results"], baseline, float(args.tolerance))
+        if regressions:
+            logging.error(f"{len(regressions)} benchmarks are slower than baseline")
+            sys.exit(1)
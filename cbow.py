@@ -7,165 +7,148 @@ __modelname__ = "CBOW"
 __author__ = "Martin Fajčík"
 
 import argparse
-import pickle
+import sys
 import numpy as np
 import torch
-import torch.nn as nn
 import logging
 
-from nlpfit.preprocessing.nlp_io import read_word_lists
-from collections import deque
 from word2vec import init_argparser_general, DataProcessor, Word2Vec, init_logging
+from profile_run import init_argparser_profile, run_profile
 
 
 class CBOW(Word2Vec):
     def intristric_eval(self):
-        return intrinstric_eval(self.u_embeddings, self.dp.w2id, use_cuda=self.use_cuda)
+        return intrinstric_eval(self.u_embeddings, self.wordsim)
 
     def create_embedding_matrices(self):
-        self.u_embeddings = nn.EmbeddingBag(num_embeddings=data_proc.vocab_size,
-                                            embedding_dim=data_proc.embedding_size,
-                                            sparse=True)
-        self.v_embeddings = nn.Embedding(data_proc.vocab_size, data_proc.embedding_size, sparse=True)
+        self.u_embeddings = self.create_embedding(mode="mean")
+        self.v_embeddings = self.create_embedding()
         self.init_embeddings(self.u_embeddings, self.v_embeddings)
 
     def forward(self, batch):
-        ##########################
-        # Parse input from batch
-        ##########################
-
-        # batch contains list that looks like
-        # i.e. [([xx],y),([aaa],y2),([bbbb],y3)
-        # since we are using embedding bag, we need to parse this example format where:
-
-        # pos: flatten list of all word sequences i.e. [xxaaabbbb]
-        # indices: indices of split points in pos i.e. [0,2,5]
-        # targets: [y1,y2,y3]
-
-        indices = [0]
-        for p in batch:
-            indices.append(len(p[0]) + indices[-1])
-        indices = indices[:-1]
-
-        targets = torch.LongTensor([item[1] for item in batch])
-        pos = torch.LongTensor([item for sublist in batch for item in sublist[0]])
-        indices = torch.LongTensor(indices)
+        """Forward process.
+        batch is a tuple (contexts, offsets, targets) of word id arrays or tensors, packed for EmbeddingBag:
+            contexts: flat context word ids of all samples, shape [sum of context sizes]
+            offsets: index in contexts where context of each sample starts, shape [batch_size]
+            targets: center word ids, shape [batch_size]
+        Returns:
+            Loss of this process, a pytorch variable.
+        """
+        contexts = torch.as_tensor(batch[0], dtype=torch.long)
+        offsets = torch.as_tensor(batch[1], dtype=torch.long)
+        targets = torch.as_tensor(batch[2], dtype=torch.long)
         neg_v = self.dp.get_neg_v_neg_sampling()
-        neg_v = torch.LongTensor(neg_v)
 
         if self.use_cuda:
-            pos = pos.cuda()
-            targets = targets.cuda()
-            indices = indices.cuda()
-            neg_v = neg_v.cuda()
-
-        # Forward pass
-        # Input format:
-        #     pos: list of neighbor word ids for positive word samples.
-        #     indices: split points in pos list for each sample
-        #     targets: list of center word ids for positive word samples.
-        #     neg_v: list of neighbor word ids for negative word samples.
-        # Returns:
-        #     Loss of this process, a pytorch variable.
-        #
-        # The sizes of input variables are as following:
-        #     pos: [batch_size, random_window_size]
-        #     indices: [batch_size]
-        #     targets:
-        #     neg_v: [batch_size, neg_sampling_count]
-
-        # pick embeddings for words pos_u, pos_v
-        u_emb_batch = self.u_embeddings(pos, indices)
-        v_emb_batch = self.v_embeddings(targets)
-
-        # o is sigmoid function
-        # NS loss for 1 sample and max objective is
-        ##########################################################
-        # log o(v^T*u) + sum of k samples log o(-negative_v^T *u)#
-        ##########################################################
-        # log o(v^T*u)  = score
-        # sum of k samples log o(-negative_v^T *u) = neg_score
-
-        # Multiply element wise
-        score = torch.mul(u_emb_batch, v_emb_batch)
-        # Sum so we get dot product for each row
-        score = torch.sum(score, dim=1)
-        score = self.logsigmoid(score)
-        v_neg_emb_batch = self.v_embeddings(neg_v)
-        # v_neg_emb_batch has shape [BATCH_SIZE,NUM_OF_NEG_SAMPLES,EMBEDDING_DIMENSIONALITY]
-        # u_emb_batch has shape [BATCH_SIZE,EMBEDDING_DIMENSIONALITY]
-        neg_score = torch.bmm(v_neg_emb_batch, u_emb_batch.unsqueeze(2))
-        neg_score = self.logsigmoid(-1. * neg_score)
-
-        return -1. * (torch.sum(score) + torch.sum(neg_score)) / self.dp.batch_size
+            with self.dp.metrics.timed("to_device"):
+                contexts = contexts.cuda()
+                offsets = offsets.cuda()
+                targets = targets.cuda()
+                neg_v = neg_v.cuda()
+
+        # pick averaged embeddings of contexts
+        u_emb_batch = self.u_embeddings(contexts, offsets)
+
+        return self.negative_sampling_loss(u_emb_batch, targets, neg_v)
 
 
 class WordContextDataProcessor(DataProcessor):
     """
     This dataprocessor creates batches of words and their contexts
-    So each sample has pattern `([a,b,c,d],y)`, where `a,b,c,d` are context words and `y` is target word
+    So each sample has pattern `([a,b,c,d],y)`, where `a,b,c,d` are context words and `y` is target word.
+    Batches are packed as tuples of arrays (contexts, offsets, targets), see CBOW.forward.
     """
 
     def create_batch_gen(self):
-        # Create word list generator
-        wordgen = read_word_lists(self.corpus, bytes_to_read=self.bytes_to_read, report_bytesread=True)
-        # Create queue of random choices
-        rchoices = deque(np.random.choice(np.arange(1, self.window_size + 1), self.randints_to_precalculate))
-        # create doubles
-        word_from_last_list = []
-        window_datasamples = []
+        # Create word id list generator
+        idgen = self.create_id_list_gen()
+        # Create buffer of random reduced window sizes
+        self.init_reduced_windows()
+        # Word ids kept from the last list, centers from index si on were not processed yet
+        word_from_last_list = np.empty(0, dtype=np.int32)
         si = 0
-        for wlist_ in wordgen:
-            wlist = wlist_[0]
-            self.bytes_read = wlist_[1]
-
-            # Discard words with min_freq or less occurences
-            # Subsample of Frequent Words
-            # hese words are removed from the text before generating the contexts
-            wlist_clean = []
-            for w in wlist:
-                try:
-                    if not (self.frequency_vocab_with_OOV[w] < self.min_freq or self.should_be_subsampled(w)):
-                        wlist_clean.append(w)
-                except KeyError as e:
-                    logging.error("Encountered unknown word!\n Are you using the right vocabulary?")
-                    logging.error(e)
-                    logging.error(f"Wlist: {wlist}")
-            wlist = wlist_clean
-
-            # TODO: Phrase clustering here
-
-            if not wlist:
-                return
-
-            wlist = list(map(lambda x: self.w2id[x], wlist))
-            wlist = word_from_last_list + wlist
-            word_from_last_list = []
-            for i in range(si, len(wlist)):
-                # if the window exceeds the buffered part
-                if (i + self.window_size > len(wlist) - 1):
-                    # find index m, that points on leftmost word still in a window
-                    # of central word
-                    m = max(i - self.window_size, 0)
-
-                    # save the index of central word, with respect to start at leftmost word at position m
-                    si = i - m
-
-                    # throw away words before leftmost word, they have already been processed
-                    word_from_last_list = wlist[m:]
-                    break
-                if not rchoices:
-                    rchoices = deque(
-                        np.random.choice(np.arange(1, self.window_size + 1), self.randints_to_precalculate))
-                r = rchoices.pop()
-                if i - r < 0:
-                    continue
-                window_datasamples.append((wlist[i - r:i] + wlist[i + 1:i + r + 1], wlist[i]))
-
-            if len(window_datasamples) > self.batch_size:
-                self.log_epoch_progress()
-                yield window_datasamples[:self.batch_size]
-                window_datasamples = window_datasamples[self.batch_size:]
+        # Flat contexts of samples not yielded yet, with sizes of the contexts and their targets
+        contexts = np.empty(0, dtype=np.int32)
+        sizes = np.empty(0, dtype=np.int64)
+        targets = np.empty(0, dtype=np.int32)
+        # Words with min_freq or less occurences are discarded and frequent words are subsampled
+        # These words are removed from the text before generating the contexts
+        for wids, bytes_read in idgen:
+            self.bytes_read = bytes_read
+
+            if not len(wids):
+                continue
+
+            wids = np.concatenate((word_from_last_list, wids))
+
+            # Only centers with whole window inside the buffered part are processed now
+            stop = len(wids) - self.window_size
+            if stop > si:
+                with self.metrics.timed("pair_building"):
+                    c, s, t = self.create_windows(wids, si, stop)
+                    contexts = np.concatenate((contexts, c))
+                    sizes = np.concatenate((sizes, s))
+                    targets = np.concatenate((targets, t))
+
+            # find index m, that points on leftmost word still in a window
+            # of the first unprocessed central word
+            i = max(si, stop)
+            m = max(i - self.window_size, 0)
+            # save the index of central word, with respect to start at leftmost word at position m
+            si = i - m
+            # throw away words before leftmost word, they have already been processed
+            word_from_last_list = wids[m:]
+
+            while len(targets) >= self.batch_size:
+                batch, (contexts, sizes, targets) = self.split_batch(contexts, sizes, targets)
+                yield batch
+
+        # We reached the end of dataset, process the rest of buffered words
+        if si < len(word_from_last_list):
+            c, s, t = self.create_windows(word_from_last_list, si, len(word_from_last_list))
+            contexts = np.concatenate((contexts, c))
+            sizes = np.concatenate((sizes, s))
+            targets = np.concatenate((targets, t))
+        while len(targets):
+            if len(targets) < self.batch_size:
+                # Pad the last batch with samples of target 0 and context [0]
+                padding = self.batch_size - len(targets)
+                contexts = np.concatenate((contexts, np.zeros(padding, dtype=np.int32)))
+                sizes = np.concatenate((sizes, np.ones(padding, dtype=np.int64)))
+                targets = np.concatenate((targets, np.zeros(padding, dtype=np.int32)))
+            batch, (contexts, sizes, targets) = self.split_batch(contexts, sizes, targets)
+            yield batch
+
+    def split_batch(self, contexts, sizes, targets):
+        """
+        Splits the first batch_size samples from the buffered ones.
+        :return: tuple (batch, rest), batch is (contexts, offsets, targets), rest is (contexts, sizes, targets)
+        """
+        batch_sizes = sizes[:self.batch_size]
+        offsets = np.zeros(len(batch_sizes), dtype=np.int64)
+        np.cumsum(batch_sizes[:-1], out=offsets[1:])
+        end = offsets[-1] + batch_sizes[-1]
+        batch = (contexts[:end], offsets, targets[:self.batch_size])
+        return batch, (contexts[end:], sizes[self.batch_size:], targets[self.batch_size:])
+
+    def create_windows(self, wids, start, stop):
+        """
+        Creates context windows for central words wids[start:stop].
+        Each central word i gets its own reduced window r, its context are words at positions
+        i-r,...,i-1,i+1,...,i+r lying inside wids, so windows at the edges of the corpus are truncated.
+        Central words without any context word (corpus of one word) are left out.
+        :return: tuple (contexts, sizes, targets) of flat int32 context word ids, int64 number of context words
+                 of each central word and int32 central word ids
+        """
+        centers = np.arange(start, stop)
+        r = self.draw_reduced_windows(len(centers))
+        offsets = np.concatenate((np.arange(-self.window_size, 0), np.arange(1, self.window_size + 1)))
+        positions = centers[:, None] + offsets
+        mask = (np.abs(offsets) <= r[:, None]) & (positions >= 0) & (positions < len(wids))
+        sizes = mask.sum(axis=1)
+        nonempty = sizes > 0
+        # Row-major masking keeps the context words grouped by their central word
+        return wids[positions[mask]], sizes[nonempty], wids[centers[nonempty]]
 
 
 def init_argparser_cbow(parser):
@@ -174,6 +157,8 @@ def init_argparser_cbow(parser):
     # Optional arguments with value
     parser.add_argument("-lr", "--learning_rate", help="initial learning rate", default=0.003)
 
+    parser.add_argument("-e", "--epochs", help="number of training epochs", default=25)
+
     ## Step count parameters
     parser.add_argument("--lossreport_step", help="number of steps after which loss value is reported",
                         default=5000)
@@ -198,28 +183,25 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     init_argparser_general(parser)
     init_argparser_cbow(parser)
+    init_argparser_profile(parser)
     args = parser.parse_args()
     init_logging(args)
 
-    data_proc = WordContextDataProcessor(args, __modelname__)
-    cbow_model = CBOW(data_proc)
-
-    # We need to carefully choose optimizer and its parameters to guarantee no global update will be excuted when training.
-    # For example, parameters like weight_decay and momentum in torch.optim. SGD require the global calculation
-    # on embedding matrix, which is extremely time-consuming.
-    bytes_read = 0
-    epochs = 25
-    for e in range(epochs):
-        logging.info(f"Starting epoch: {e}")
-        bytes_read = cbow_model._train(previously_read=bytes_read, epoch=e)
-    try:
-        with open(f"trained/u_embeddings_e{epochs}.pkl", "wb") as f:
-            pickle.dump(cbow_model.u_embeddings.weight, f, protocol=pickle.HIGHEST_PROTOCOL)
-    except MemoryError as e:
-        logging.critical(e)
-    try:
-        with open(f"trained/v_embeddings_e{epochs}.pkl", "wb") as f:
-            pickle.dump(cbow_model.v_embeddings.weight, f, protocol=pickle.HIGHEST_PROTOCOL)
-    except MemoryError as e:
-        logging.critical(e)
-    cbow_model.save(f"trained/embeddings_test_e{epochs}.vec")
+    with WordContextDataProcessor(args, __modelname__) as data_proc:
+        cbow_model = CBOW(data_proc)
+        if args.profile:
+            run_profile(cbow_model, args)
+            sys.exit()
+
+        # We need to carefully choose optimizer and its parameters to guarantee no global update will be excuted when training.
+        # For example, parameters like weight_decay and momentum in torch.optim. SGD require the global calculation
+        # on embedding matrix, which is extremely time-consuming.
+        start_epoch, bytes_read = cbow_model.resume() if args.resume else (0, 0)
+        epochs = data_proc.epochs
+        for e in range(start_epoch, epochs):
+            logging.info(f"Starting epoch: {e}")
+            bytes_read = cbow_model._train(previously_read=bytes_read, epoch=e)
+        if data_proc.rank == 0:
+            # Both embedding matrices in binary torch format
+            torch.save(cbow_model.state_dict(), f"trained/embeddings_e{epochs}.pt")
+            cbow_model.save(f"trained/embeddings_test_e{epochs}.{args.save_format}")
@@ -0,0 +1,68 @@
+import logging
+import os
+import threading
+
+import numpy as np
+import torch
+
+
+def _to_cpu(state):
+    """
+    Copies all tensors of (nested) state to CPU memory, so training can continue while the copy is written.
+    """
+    if torch.is_tensor(state):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {k: _to_cpu(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(_to_cpu(v) for v in state)
+    return state
+
+
+class Checkpointer:
+    """
+    Writes training checkpoints with torch.save in a background thread, so training does not stall on disk.
+    State is snapshotted in the calling thread; at most one checkpoint is being written at a time.
+    The checkpoint is written into a temporary file first, so a crash while writing keeps the previous one.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.writer = None
+
+    def wait(self):
+        if self.writer is not None:
+            self.writer.join()
+            self.writer = None
+
+    def save(self, state):
+        self.wait()
+        state = _to_cpu(state)
+        # Not a daemon, interpreter waits for the last checkpoint to be written
+        self.writer = threading.Thread(target=self._write, args=(state,))
+        self.writer.start()
+
+    def _write(self, state):
+        tmp_path = f"{self.path}.tmp"
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, self.path)
+        logging.info(f"Checkpoint of epoch {state['epoch']} at byte {state['bytes_read']} saved to {self.path}")
+
+
+def rng_state():
+    state = {"numpy": np.random.get_state(), "torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def load_checkpoint(path):
+    # Checkpoint contains numpy RNG state, which is not a plain tensor
+    return torch.load(path, map_location="cpu", weights_only=False)
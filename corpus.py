@@ -0,0 +1,139 @@
+import os
+import struct
+import zlib
+
+import numpy as np
+
+
+def corpus_shards(corpus, num_shards):
+    """
+    Splits corpus file into num_shards byte ranges of roughly the same size.
+    Every boundary is moved forward onto the nearest whitespace, so no word is split between two shards.
+    :return: list of (start, end) byte offsets
+    """
+    fsize = os.path.getsize(corpus)
+    boundaries = [0]
+    with open(corpus, "rb") as f:
+        for i in range(1, num_shards):
+            offset = max(fsize * i // num_shards, boundaries[-1])
+            f.seek(offset)
+            while True:
+                c = f.read(1)
+                if not c or c.isspace():
+                    break
+                offset += 1
+            boundaries.append(offset)
+    boundaries.append(fsize)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def word_start_offset(corpus, offset):
+    """
+    Moves offset of the corpus file back onto the start of the word it points into,
+    so reading from the returned offset does not split the word.
+    """
+    with open(corpus, "rb") as f:
+        while offset > 0:
+            start = max(offset - 512, 0)
+            f.seek(start)
+            chunk = f.read(offset - start)
+            split = max(chunk.rfind(ws) for ws in (b" ", b"\n", b"\t", b"\r"))
+            if split >= 0:
+                return start + split + 1
+            offset = start
+    return 0
+
+
+def read_word_lists_range(corpus, start, end, bytes_to_read=512):
+    """
+    Reads words from byte range [start, end) of the corpus file, the range should be aligned to whitespace
+    (see corpus_shards).
+    Yields the same tuples as nlpfit's read_word_lists with report_bytesread=True,
+    i.e. (list of words, bytes read from the start of the range).
+    """
+    bytes_to_read = int(bytes_to_read)
+    bytes_read = 0
+    rest = b""
+    with open(corpus, "rb") as f:
+        f.seek(start)
+        while bytes_read < end - start:
+            chunk = f.read(min(bytes_to_read, end - start - bytes_read))
+            if not chunk:
+                break
+            bytes_read += len(chunk)
+            chunk = rest + chunk
+            # Keep the last (possibly unfinished) word for the next chunk
+            split = max(chunk.rfind(ws) for ws in (b" ", b"\n", b"\t", b"\r"))
+            if split < 0:
+                rest = chunk
+                continue
+            rest = chunk[split:]
+            yield chunk[:split].decode("utf-8", errors="ignore").split(), bytes_read
+    if rest.strip():
+        yield rest.decode("utf-8", errors="ignore").split(), bytes_read
+
+
+# Compiled corpus is a flat array of int32 word ids preceded by a header of HEADER_SIZE bytes
+COMPILED_CORPUS_MAGIC = b"W2VCORP1"
+# magic, number of tokens, vocabulary size, vocabulary checksum
+HEADER = struct.Struct("<8sQII")
+HEADER_SIZE = 64
+ID_SIZE = np.dtype(np.int32).itemsize
+
+
+def vocab_checksum(words):
+    """
+    Checksum of words ordered by their id, used to check the compiled corpus matches the vocabulary.
+    """
+    return zlib.crc32("\n".join(words).encode("utf-8"))
+
+
+def write_compiled_corpus(path, id_lists, vocab_size, checksum):
+    """
+    Writes arrays of word ids from id_lists into the compiled corpus file.
+    :return: number of written tokens
+    """
+    tokens = 0
+    with open(path, "wb") as f:
+        f.write(bytes(HEADER_SIZE))
+        for ids in id_lists:
+            f.write(np.asarray(ids, dtype=np.int32).tobytes())
+            tokens += len(ids)
+        f.seek(0)
+        f.write(HEADER.pack(COMPILED_CORPUS_MAGIC, tokens, vocab_size, checksum))
+    return tokens
+
+
+class CompiledCorpus:
+    """
+    Memory-mapped compiled corpus. Byte offsets used by its methods are relative to the start of the id array.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            magic, self.tokens, self.vocab_size, self.checksum = HEADER.unpack(f.read(HEADER.size))
+        if magic != COMPILED_CORPUS_MAGIC:
+            raise ValueError(f"{path} is not a compiled corpus file.")
+        if self.tokens:
+            self.ids = np.memmap(path, dtype=np.int32, mode="r", offset=HEADER_SIZE, shape=(self.tokens,))
+        else:
+            self.ids = np.empty(0, dtype=np.int32)
+        self.nbytes = self.tokens * ID_SIZE
+
+    def shards(self, num_shards):
+        """
+        :return: list of num_shards (start, end) byte ranges aligned to word ids
+        """
+        boundaries = [self.tokens * i // num_shards * ID_SIZE for i in range(num_shards + 1)]
+        return list(zip(boundaries[:-1], boundaries[1:]))
+
+    def read_id_lists(self, start, end, bytes_to_read=512):
+        """
+        Yields tuples (int32 array of word ids, bytes read from the start of the range) from byte range [start, end).
+        Arrays are views into the memory-mapped file, nothing is copied.
+        """
+        ids_to_read = max(int(bytes_to_read) // ID_SIZE, 1)
+        first, last = start // ID_SIZE, end // ID_SIZE
+        for i in range(first, last, ids_to_read):
+            j = min(i + ids_to_read, last)
+            yield self.ids[i:j], (j - first) * ID_SIZE
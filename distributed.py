@@ -0,0 +1,160 @@
+import logging
+import os
+import time
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+# How replicas of the model are kept in sync
+SYNC_MODES = ("sparse_gradients", "average")
+
+
+def init_distributed():
+    """
+    Joins the process group over gloo, which works on CPU-only clusters too.
+    Rank, world size and master address are read from environment variables set by torchrun
+    (RANK, WORLD_SIZE, MASTER_ADDR, MASTER_PORT), so several local processes can be started with
+    torchrun --nproc_per_node=N skipgram.py --distributed ...
+    :return: tuple (rank, world size)
+    """
+    dist.init_process_group("gloo", init_method="env://")
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    if torch.cuda.is_available():
+        torch.cuda.set_device(int(os.environ.get("LOCAL_RANK", rank)) % torch.cuda.device_count())
+    logging.info(f"Joined distributed training as rank {rank} of {world_size}")
+    return rank, world_size
+
+
+def master_parameters(model):
+    """
+    :return: float32 master copies of parameters kept by MasterWeightsOptimizer, empty list for other optimizers
+    """
+    return getattr(model.optimizer, "master_params", [])
+
+
+def broadcast_parameters(model):
+    """
+    Makes all ranks start from parameters of rank 0, including master copies of the optimizer
+    (it has to be created before), and gives every rank its own random streams (see seed_rank).
+    """
+    for p in list(model.parameters()) + master_parameters(model):
+        dist.broadcast(p.data, src=0)
+    seed_rank()
+
+
+def seed_rank():
+    """
+    Gives every rank its own random streams of negative samples, reduced windows and subsampling,
+    seeded from the current random state offset by the rank. It is called again after the random state
+    saved by rank 0 is restored from checkpoint, which would make the streams of all ranks the same.
+    """
+    seed = np.random.randint(2 ** 31)
+    rank = dist.get_rank()
+    torch.manual_seed(seed + rank)
+    np.random.seed(seed + rank)
+
+
+def all_reduce_gradients(model):
+    """
+    Averages gradients over ranks. Sparse gradients of embeddings are coalesced and exchanged as
+    (row indices, row values), so only rows touched by some rank in this step are sent.
+    """
+    world_size = dist.get_world_size()
+    for p in model.parameters():
+        if p.grad is None:
+            continue
+        if p.grad.is_sparse:
+            work = dist.all_reduce(p.grad.coalesce(), async_op=True)
+            work.wait()
+            p.grad = work.result()[0].div_(world_size)
+        else:
+            dist.all_reduce(p.grad)
+            p.grad.div_(world_size)
+
+
+@torch.no_grad()
+def average_parameters(model):
+    """
+    Averages parameters over ranks. With master weights, the float32 master copies are averaged
+    and rounded into the low precision parameters, so both stay the same on all ranks.
+    """
+    world_size = dist.get_world_size()
+    masters = master_parameters(model)
+    for p in masters if masters else model.parameters():
+        dist.all_reduce(p.data)
+        p.data.div_(world_size)
+    for p, m in zip(model.parameters(), masters):
+        p.copy_(m)
+
+
+def all_active(active, bytes_read=0):
+    """
+    :param bytes_read: bytes read by this rank
+    :return: tuple (True if all ranks still have batches to train on, bytes read by all ranks)
+    """
+    state = torch.tensor([int(not active), bytes_read], dtype=torch.long)
+    dist.all_reduce(state)
+    inactive, total_read = state.tolist()
+    return inactive == 0, total_read
+
+
+def train_distributed(model, previously_read=0, epoch=0):
+    """
+    Trains one epoch, each rank on its own byte range of the corpus.
+    With sparse_gradients sync, gradients are averaged in every step and the learning rate is decayed by bytes
+    read by all ranks, exchanged together with the end of epoch flag, so all replicas stay the same.
+    With average sync, replicas train locally and parameters are averaged every sync_step steps,
+    between the syncs the learning rate is decayed assuming other ranks read as much as this one.
+    The epoch ends for all ranks when the first of them runs out of its shard, shards are of the same byte size.
+    Validation and logging run on rank 0 only.
+    :return: total number of bytes read by all ranks
+    """
+    dp = model.dp
+    dp.init_benchmark()
+    dp.corpus_range = dp.create_corpus_shards(dp.world_size)[dp.rank]
+    metrics = dp.metrics
+    batch_gen = dp.create_batch_gen()
+    iteration = 0
+    while True:
+        t = time.time()
+        with metrics.timed("batching"):
+            batch = next(batch_gen, None)
+        dp.time_waiting_for_data += time.time() - t
+        with metrics.timed("synchronization"):
+            if dp.sync_mode == "sparse_gradients":
+                active, total_read = all_active(batch is not None, dp.bytes_read)
+                if not active:
+                    break
+            elif batch is None:
+                all_active(False)
+                average_parameters(model)
+                break
+            else:
+                # Shards are read at similar pace, so other ranks are assumed to have read as much as this one
+                total_read = dp.bytes_read * dp.world_size
+
+        t = time.time()
+        # train_step decays the learning rate by bytes_read + previously_read of this rank
+        loss = model.train_step(batch, previously_read=total_read - dp.bytes_read + previously_read)
+        dp.time_computing += time.time() - t
+
+        if dp.sync_mode == "average" and (iteration + 1) % dp.sync_step == 0:
+            with metrics.timed("synchronization"):
+                active, _ = all_active(True)
+                average_parameters(model)
+            if not active:
+                break
+
+        dp.report_throughput()
+        if dp.rank == 0:
+            model.validate_and_log_step(epoch, loss, iteration, previously_read=previously_read)
+        iteration += 1
+
+    bytes_read = torch.tensor([dp.bytes_read, dp.unknown_words], dtype=torch.long)
+    dist.all_reduce(bytes_read)
+    dp.bytes_read, dp.unknown_words = bytes_read.tolist()
+    dp.corpus_range = None
+    if dp.rank == 0:
+        model.log_epoch_end(epoch, iteration)
+    return dp.bytes_read + previously_read
@@ -0,0 +1,196 @@
+import gzip
+import itertools
+import logging
+import os
+
+import numpy as np
+
+# Number of rows formatted and written at once
+BLOCK_SIZE = 10000
+
+
+def write_vec(path, words, vectors, block_size=BLOCK_SIZE):
+    """
+    Writes text .vec file, header "<vocab size> <dimension>" followed by one line per word,
+    i.e. "the -0.10363 -0.063669 0.032436 ...". Lines are formatted and written in blocks of block_size rows.
+    """
+    vocab_size, dimension = vectors.shape
+    row_format = "%s" + " %.8g" * dimension + "\n"
+    # Using linux file endings
+    with open(path, "w", encoding="utf-8", newline="\n") as f:
+        f.write(f"{vocab_size} {dimension}\n")
+        for start in range(0, vocab_size, block_size):
+            rows = vectors[start:start + block_size].tolist()
+            f.write("".join(row_format % (word, *row) for word, row in zip(words[start:start + block_size], rows)))
+
+
+def write_vec_binary(path, words, vectors, block_size=BLOCK_SIZE):
+    """
+    Writes binary word2vec file (as written by the original word2vec with -binary 1), text header
+    "<vocab size> <dimension>\n" followed by "<word> <dimension float32s>\n" records.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype="<f4")
+    vocab_size, dimension = vectors.shape
+    with open(path, "wb") as f:
+        f.write(f"{vocab_size} {dimension}\n".encode("utf-8"))
+        for start in range(0, vocab_size, block_size):
+            block = vectors[start:start + block_size]
+            f.write(b"".join(word.encode("utf-8") + b" " + row.tobytes() + b"\n"
+                             for word, row in zip(words[start:start + block_size], block)))
+
+
+def vocab_sidecar_path(path):
+    return os.path.splitext(path)[0] + ".vocab.txt"
+
+
+def write_npy(path, words, vectors):
+    """
+    Writes the embedding matrix as raw .npy array and words ordered by row into vocab sidecar file,
+    one word per line.
+    """
+    np.save(path, np.ascontiguousarray(vectors, dtype=np.float32))
+    with open(vocab_sidecar_path(path), "w", encoding="utf-8", newline="\n") as f:
+        f.write("\n".join(words) + "\n")
+
+
+def _is_header(line):
+    fields = line.split()
+    return len(fields) == 2 and all(f.isdigit() for f in fields)
+
+
+def read_vec(path, top_k=None, words=None, block_size=BLOCK_SIZE, lowercase=False):
+    """
+    Reads text .vec file (optionally gzipped), the header line is skipped if there is one.
+    Lines are parsed by NumPy in blocks of block_size lines.
+    :param top_k: read only first top_k words
+    :param words: read only words from this set
+    :param lowercase: lowercase words of the file, before they are matched with words
+    :return: tuple (list of words, float32 matrix of embeddings with shape [number of words, dimension])
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    read_words, blocks = [], []
+    with opener(path, "rt", encoding="utf-8") as f:
+        first = f.readline()
+        lines = itertools.chain([] if _is_header(first) else [first], f)
+        if top_k is not None:
+            lines = itertools.islice(lines, top_k)
+        while True:
+            block = list(itertools.islice(lines, block_size))
+            if not block:
+                break
+            block = [line.rstrip("\n").split(" ", 1) for line in block if line.strip()]
+            if lowercase:
+                block = [(fields[0].lower(), fields[1]) for fields in block]
+            if words is not None:
+                block = [fields for fields in block if fields[0] in words]
+            if not block:
+                continue
+            read_words.extend(fields[0] for fields in block)
+            values = np.fromstring(" ".join(fields[1] for fields in block), dtype=np.float32, sep=" ")
+            blocks.append(values.reshape(len(block), -1))
+    if not blocks:
+        return read_words, np.empty((0, 0), dtype=np.float32)
+    return read_words, np.concatenate(blocks)
+
+
+def read_vec_binary(path):
+    """
+    :return: tuple (list of words, float32 matrix of embeddings with shape [vocab size, dimension]),
+             vectors are taken from the file content without any parsing
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    pos = data.index(b"\n") + 1
+    vocab_size, dimension = map(int, data[:pos].split())
+    row_bytes = dimension * 4
+    words = []
+    vectors = np.empty((vocab_size, dimension), dtype=np.float32)
+    for i in range(vocab_size):
+        # Some writers separate the records with newlines, some do not
+        while data[pos:pos + 1] == b"\n":
+            pos += 1
+        space = data.index(b" ", pos)
+        words.append(data[pos:space].decode("utf-8", errors="replace"))
+        vectors[i] = np.frombuffer(data, dtype="<f4", count=dimension, offset=space + 1)
+        pos = space + 1 + row_bytes
+    return words, vectors
+
+
+def read_npy(path, mmap=True):
+    """
+    :return: tuple (list of words, float32 matrix of embeddings), the matrix is memory-mapped if mmap is set
+    """
+    vectors = np.load(path, mmap_mode="r" if mmap else None)
+    with open(vocab_sidecar_path(path), "r", encoding="utf-8") as f:
+        words = f.read().split("\n")[:len(vectors)]
+    return words, vectors
+
+
+EXPORT_FORMATS = {
+    "vec": (write_vec, read_vec),
+    "bin": (write_vec_binary, read_vec_binary),
+    "npy": (write_npy, read_npy)
+}
+
+
+def export_format(path):
+    """
+    Infers export format from the file extension, text .vec is the default.
+    """
+    extension = os.path.splitext(path)[1][1:]
+    return extension if extension in EXPORT_FORMATS else "vec"
+
+
+def save_embeddings(path, words, vectors, fmt=None):
+    fmt = fmt or export_format(path)
+    logging.info(f"Saving {fmt} file to {path}")
+    EXPORT_FORMATS[fmt][0](path, words, vectors)
+
+
+def load_embeddings(path, fmt=None):
+    """
+    :return: tuple (list of words, float32 matrix of embeddings with shape [vocab size, dimension])
+    """
+    fmt = fmt or export_format(path)
+    return EXPORT_FORMATS[fmt][1](path)
+
+
+def cache_path(path):
+    return f"{path}.npy"
+
+
+def load_vectors(path, top_k=None, words=None, cache=False, lowercase=False):
+    """
+    Fast loader of exported embeddings in any format.
+    With cache, the whole text .vec file parsed once is cached as .npy matrix with vocabulary sidecar next to it,
+    later loads only memory-map the cache. If the cache cannot be written, only the requested words are read.
+    :param top_k: load only first top_k words (the most frequent ones in files saved by Word2Vec.save)
+    :param words: load only words from this collection
+    :param lowercase: lowercase loaded words, before they are matched with words
+    :return: tuple (list of words, float32 matrix of embeddings)
+    """
+    fmt = export_format(path.rsplit(".gz", 1)[0])
+    words = set(words) if words is not None else None
+    cached = cache and os.path.exists(cache_path(path)) and os.path.getmtime(cache_path(path)) >= os.path.getmtime(path)
+    if fmt != "vec":
+        loaded_words, vectors = load_embeddings(path, fmt=fmt)
+    elif cached:
+        loaded_words, vectors = read_npy(cache_path(path))
+    elif cache:
+        loaded_words, vectors = read_vec(path)
+        logging.info(f"Caching parsed {path} into {cache_path(path)}")
+        try:
+            write_npy(cache_path(path), loaded_words, vectors)
+        except OSError as e:
+            logging.warning(f"Parsed {path} could not be cached: {e}")
+    else:
+        return read_vec(path, top_k=top_k, words=words, lowercase=lowercase)
+
+    if top_k is not None:
+        loaded_words, vectors = loaded_words[:top_k], vectors[:top_k]
+    if lowercase:
+        loaded_words = [w.lower() for w in loaded_words]
+    if words is not None:
+        rows = [i for i, w in enumerate(loaded_words) if w in words]
+        loaded_words, vectors = [loaded_words[i] for i in rows], vectors[rows]
+    return loaded_words, vectors
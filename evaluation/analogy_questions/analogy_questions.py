@@ -1,10 +1,17 @@
+import os
 import torch
 import logging
 import numpy as np
 import torch.nn.functional as F
 
+from sharded_embedding import embedding_blocks, embedding_rows
+
 # Method taken from tensorflow/models skipgram
-from torch.nn import EmbeddingBag
+
+# Fraction of available memory used by the [N, vocab_size] score matrix of one batch of questions
+MEMORY_FRACTION = 0.25
+# Bounds of the number of questions evaluated at once
+MIN_BATCH, MAX_BATCH = 32, 8192
 
 
 def read_analogies(file, w2id):
@@ -12,13 +19,17 @@ def read_analogies(file, w2id):
     Returns:
       questions: a [n, 4] numpy array containing the analogy question's
                  word ids.
-      questions_skipped: questions skipped due to unknown words.
+      sections: list of (section name, start, stop) ranges of questions
+                under each ": section" header of the file.
+    Questions with unknown words are skipped.
     """
     questions = []
     questions_skipped = 0
+    sections = []
     with open(file, "rb") as analogy_f:
         for line in analogy_f:
-            if line.startswith(b":"):  # Skip comments.
+            if line.startswith(b":"):  # Section header.
+                sections.append([line[1:].decode().strip(), len(questions), len(questions)])
                 continue
             words = line.decode().strip().lower().split()
             ids = [w2id.get(w.strip(), None) for w in words]
@@ -26,6 +37,8 @@ def read_analogies(file, w2id):
                 questions_skipped += 1
             else:
                 questions.append(np.array(ids))
+                if sections:
+                    sections[-1][2] = len(questions)
 
     logging.info("###########################################")
     logging.info("Loaded evaluation method: Question analogy")
@@ -34,87 +47,76 @@ def read_analogies(file, w2id):
     logging.info("Questions: "+ str(len(questions)))
     logging.info("Skipped: "+ str(questions_skipped))
     logging.info("###########################################\n")
-    return np.array(questions, dtype=np.int32)
+    return np.array(questions, dtype=np.int32).reshape(-1, 4), [tuple(s) for s in sections]
+
+
+def available_memory(device):
+    if device.type == "cuda":
+        return torch.cuda.mem_get_info(device)[0]
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def analogy_batch_size(vocab_size, device):
+    """
+    Number of questions, whose float32 scores over the whole vocabulary fit into a fraction of available memory.
+    """
+    n = int(available_memory(device) * MEMORY_FRACTION) // (vocab_size * 4)
+    return min(max(n, MIN_BATCH), MAX_BATCH)
 
 
 # Each analogy task is to predict the 4th word (d) given three
 # words: a, b, c.  E.g., a=italy, b=rome, c=france, we should
 # predict d=paris
-def eval_analogy_questions(data_processor, embeddings, use_cuda):
-    """Evaluate analogy questions and reports accuracy."""
-
-    is_embedding_bag = type(embeddings) is EmbeddingBag
-    # How many questions we get right at precision@1.
-    correct = 0
+def eval_analogy_questions(data_processor, embeddings, name=""):
+    """Evaluate analogy questions and reports accuracy, overall and for each section of questions.
+    Returns overall accuracy."""
     aq = data_processor.analogy_questions
     total = aq.shape[0]
+    if not total:
+        return 0.
+
+    # Rows of the matrix are kept in (first row id, weight) blocks, one for nn.Embedding and nn.EmbeddingBag
+    # and one for each shard of ShardedEmbedding, each block is scored on its own device.
+    # Normalize blocks so we can calculate cosine distances with dot product
+    nblocks = [(block_start, F.normalize(weight.detach().float()))
+               for block_start, weight in embedding_blocks(embeddings)]
+    questions = torch.from_numpy(aq).long()
+    batch_size = min(analogy_batch_size(len(nembs), nembs.device) for _, nembs in nblocks)
 
-    start = 0
-    # Lower the N, if you are running out of memory
-    N = 32
-    predict_item_index = 3
-
-    # Normalize matrix so we can calculate cosine distances with dot product
-
-    nembs = torch.transpose(F.normalize(embeddings.weight), 0, 1)
-    while start < total:
-        limit = start + N
-        analogy = aq[start:limit, :]
-
-        # Each row of a_emb, b_emb, c_emb is a word's embedding vector.
-        # They all have the shape [N, emb_dim]
-        a = torch.LongTensor(analogy[:, 0])
-        b = torch.LongTensor(analogy[:, 1])
-        c = torch.LongTensor(analogy[:, 2])
-
-        if is_embedding_bag:
-            arange = torch.LongTensor(range(len(a)))
-            brange = torch.LongTensor(range(len(b)))
-            crange = torch.LongTensor(range(len(c)))
-
-        if use_cuda:
-            a = a.cuda()
-            b = b.cuda()
-            c = c.cuda()
-            if is_embedding_bag:
-                arange = arange.cuda()
-                brange = brange.cuda()
-                crange = crange.cuda()
-
-        if is_embedding_bag:
-            a_emb = embeddings(a, arange)
-            b_emb = embeddings(b, brange)
-            c_emb = embeddings(c, crange)
-        else:
-            a_emb = embeddings(a)
-            b_emb = embeddings(b)
-            c_emb = embeddings(c)
+    correct = torch.empty(total, dtype=torch.bool)
+    for start in range(0, total, batch_size):
+        analogy = questions[start:start + batch_size]
 
         # We expect that d's embedding vectors analogies are
         # near: c_emb + (b_emb - a_emb), which has the shape [N, emb_dim].
-        d_emb = c_emb + b_emb - a_emb
-        
-        # normalize d_emb embeddings
-        d_emb = F.normalize(d_emb)
-
-        # Compute cosine distance of d_emb to each vocab word
-        # dist has shape [N, vocab_size]
-        dist = torch.matmul(d_emb, nembs)
-
-        # top_k closest EMBEDDINGS
-        top_predicted = torch.topk(dist, dim=1, k=4)[1].cpu().numpy()
-
-        start = limit
-        for question in range(analogy.shape[0]):
-            for j in range(4):
-                if top_predicted[question, j] == analogy[question, predict_item_index]:
-                    # Bingo! We predicted correctly. E.g., [italy, rome, france, paris].
-                    correct += 1
-                    break
-                elif top_predicted[question, j] in analogy[question, :predict_item_index]:
-                    # We need to skip words already in the question.
-                    continue
-                else:
-                    # The correct label is not the precision@1
-                    break
-    logging.info("Eval analogy questions %4d/%d accuracy = %4.1f%%" % (correct, total, correct * 100.0 / total))
+        question_emb = embedding_rows(embeddings, analogy[:, :3].reshape(-1)).view(len(analogy), 3, -1)
+        a_emb, b_emb, c_emb = question_emb.unbind(1)
+        d_emb = F.normalize(c_emb + b_emb - a_emb)
+
+        best_scores = torch.full((len(analogy),), float("-inf"))
+        best_ids = torch.zeros(len(analogy), dtype=torch.long)
+        for block_start, nembs in nblocks:
+            # Compute cosine distance of d_emb to each word of the block
+            # dist has shape [N, block_size]
+            dist = torch.matmul(d_emb.to(nembs.device), nembs.t())
+            # Words of the question can not be the answer
+            local = analogy[:, :3].to(nembs.device) - block_start
+            rows, columns = ((local >= 0) & (local < len(nembs))).nonzero(as_tuple=True)
+            dist[rows, local[rows, columns]] = float("-inf")
+            scores, ids = dist.max(dim=1)
+            better = scores.cpu() > best_scores
+            best_scores = torch.where(better, scores.cpu(), best_scores)
+            best_ids = torch.where(better, ids.cpu() + block_start, best_ids)
+        # Bingo! We predicted correctly. E.g., [italy, rome, france, paris].
+        correct[start:start + batch_size] = best_ids == analogy[:, 3]
+
+    for section, section_start, section_stop in data_processor.analogy_sections:
+        if section_stop > section_start:
+            section_correct = int(correct[section_start:section_stop].sum())
+            section_total = section_stop - section_start
+            logging.info("Eval analogy questions %s section %s %4d/%d accuracy = %4.1f%%" %
+                         (name, section, section_correct, section_total, section_correct * 100.0 / section_total))
+    total_correct = int(correct.sum())
+    logging.info("Eval analogy questions %s %4d/%d accuracy = %4.1f%%" %
+                 (name, total_correct, total, total_correct * 100.0 / total))
+    return total_correct / total
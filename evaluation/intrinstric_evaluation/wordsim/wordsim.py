@@ -5,8 +5,11 @@ import numpy
 from collections import defaultdict
 
 import torch
+import torch.nn.functional as F
 from scipy import linalg, mat, dot, stats
-from torch.nn import EmbeddingBag
+
+from embedding_io import load_vectors
+from sharded_embedding import embedding_rows
 
 DATA_ROOT = os.path.dirname(os.path.abspath(__file__)) + "/data/"
 
@@ -19,7 +22,9 @@ class Wordsim:
         self.dataset = defaultdict(list)
         for file_name in self.files:
             for line in open(DATA_ROOT + lang + "/" + file_name + ".txt"):
-                self.dataset[file_name].append([float(w) if i == 2 else w for i, w in enumerate(line.strip().split())])
+                # Words are lowercased, as are words of evaluated vectors (see load_vector)
+                self.dataset[file_name].append([float(w) if i == 2 else w.lower()
+                                                for i, w in enumerate(line.strip().split())])
 
     @staticmethod
     def cos(vec1, vec2):
@@ -30,21 +35,17 @@ class Wordsim:
         return stats.stats.spearmanr(vec1, vec2)[0]
 
     @staticmethod
-    def load_vector(path):
-        try:
-            logging.info("loading vector ..")
-            if path[-3:] == ".gz":
-                import gzip
-                f = gzip.open(path, "rb")
-            else:
-                f = open(path, "rb")
-        except ValueError:
-            logging.error("Oops!  No such file.  Try again ..")
+    def load_vector(path, top_k=None, words=None, cache=False):
+        """
+        Words of the file and words are matched lowercased.
+        :return: dict of lowercased word -> vector, the first vector of the file is kept for words differing in case
+        """
+        logging.info("loading vector ..")
+        words = {w.lower() for w in words} if words is not None else None
+        loaded_words, vectors = load_vectors(path, top_k=top_k, words=words, cache=cache, lowercase=True)
         word2vec = {}
-        for wn, line in enumerate(f):
-            line = line.lower().strip()
-            word = line.split()[0]
-            word2vec[word] = numpy.array(map(float, line.split()[1:]))
+        for w, v in zip(loaded_words, vectors):
+            word2vec.setdefault(w, v)
         logging.info("loaded vector {0} words found ..".format(len(word2vec.keys())))
         return word2vec
 
@@ -78,44 +79,58 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--lang', '-l', default="en")
     parser.add_argument('--vector', '-v', default="")
+    parser.add_argument('--cache', help="cache parsed .vec file as .npy next to it", action="store_true")
     args = parser.parse_args()
     wordsim = Wordsim(args.lang)
-    word2vec = wordsim.load_vector(args.vector)
+    # Only words of the datasets are needed
+    dataset_words = {w for data in wordsim.dataset.values() for datum in data for w in datum[:2]}
+    word2vec = wordsim.load_vector(args.vector, words=dataset_words, cache=args.cache)
     result = wordsim.evaluate(word2vec)
     wordsim.pprint(result)
 
 
-class EmbeddingDict():
-    def __init__(self, nnembedding, w2id, use_cuda):
-        self.emb = nnembedding
-        self.use_cuda = use_cuda
-        self.w2id = w2id
-
-    def __getitem__(self, key):
-        key = torch.LongTensor([self.w2id[key]])
-        rng = torch.LongTensor(range(len(key)))
-        if self.use_cuda:
-            key = key.cuda()
-            rng = rng.cuda()
-        if type(self.emb) is EmbeddingBag:
-            return self.emb(key, rng).cpu().squeeze(0).detach().numpy()
-        else:
-            return self.emb(key).cpu().squeeze(0).detach().numpy()
+class CompiledWordsim:
+    """
+    Wordsim datasets with words mapped to ids of the trained vocabulary.
+    Datasets are read and mapped once, each evaluation then scores every dataset with a single gather
+    of embedding rows, row-wise cosine similarity and Spearman correlation.
+    """
 
-    def keys(self):
-        return self.w2id.keys()
+    def __init__(self, w2id, lang="en"):
+        self.datasets = {}
+        # Dataset words are lowercased, words differing only in case get id of the most frequent one
+        lowercase_w2id = {}
+        for w, i in sorted(w2id.items(), key=lambda wi: wi[1]):
+            lowercase_w2id.setdefault(w.lower(), i)
+        w2id = lowercase_w2id
+        for file_name, data in Wordsim(lang).dataset.items():
+            found = [datum for datum in data if datum[0] in w2id and datum[1] in w2id]
+            ids = torch.LongTensor([[w2id[datum[0]], w2id[datum[1]]] for datum in found]).view(-1, 2)
+            labels = numpy.array([datum[2] for datum in found])
+            self.datasets[file_name] = (ids, labels, len(data) - len(found))
+
+    def evaluate(self, embedding):
+        """
+        :param embedding: nn.Embedding, nn.EmbeddingBag or ShardedEmbedding, row i is the embedding of word with id i
+        :return: dict of dataset name -> (found, not found, Spearman's rho * 100)
+        """
+        result = {}
+        for file_name, (ids, labels, notfound) in self.datasets.items():
+            if not len(ids):
+                result[file_name] = (0, notfound, float("nan"))
+                continue
+            pairs = embedding_rows(embedding, ids.view(-1)).view(len(ids), 2, -1)
+            pred = F.cosine_similarity(pairs[:, 0], pairs[:, 1]).cpu().numpy()
+            result[file_name] = (len(ids), notfound, Wordsim.rho(labels, pred) * 100)
+        return result
 
 
-def intrinstric_eval(nnembedding, w2id, lang="en", use_cuda=False):
+def intrinstric_eval(nnembedding, wordsim):
     """
-    :param nnembedding: embedding matrix  to evaluate
-    :param w2id:
-    :param lang:
-    :param use_cuda:
-    :return:
+    :param nnembedding: nn.Embedding, nn.EmbeddingBag or ShardedEmbedding to evaluate
+    :param wordsim: CompiledWordsim with the vocabulary of nnembedding
+    :return: dict of dataset name -> (found, not found, Spearman's rho * 100)
     """
-    wordsim = Wordsim(lang)
-    word2vec = EmbeddingDict(nnembedding, w2id, use_cuda)
-    result = wordsim.evaluate(word2vec)
-    wordsim.pprint(result)
+    result = wordsim.evaluate(nnembedding)
+    Wordsim.pprint(result)
     return result
@@ -0,0 +1,119 @@
+import logging
+import queue
+import time
+import traceback
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+# Seconds to wait for a report before checking that workers are still alive
+REPORT_TIMEOUT = 1.
+
+
+def _train_worker(model, worker_id, shard, seed, report_queue, report_step, workers, previously_read):
+    """
+    Trains shared model on its own byte range of the corpus, without any locking of parameters.
+    Every report_step iterations a report (worker_id, bytes read, unknown words, iterations, loss sum,
+    metrics snapshot, finished) is sent to the parent process.
+    """
+    try:
+        # Workers should not compete for cores with each other
+        torch.set_num_threads(1)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        dp = model.dp
+        dp.corpus_range = shard
+        dp.bytes_read = 0
+        dp.unknown_words = 0
+        # Only stages of this worker are reported
+        dp.metrics.reset()
+        iterations, loss_sum = 0, 0.
+        for batch in dp.create_batch_gen():
+            # Shards are read at similar pace, so other workers are assumed to have read as much as this one
+            loss = model.train_step(batch, previously_read=dp.bytes_read * (workers - 1) + previously_read)
+            iterations += 1
+            loss_sum += loss.item()
+            if iterations == report_step:
+                report_queue.put((worker_id, dp.bytes_read, dp.unknown_words, iterations, loss_sum,
+                                  dp.metrics.snapshot(), False))
+                iterations, loss_sum = 0, 0.
+        report_queue.put((worker_id, dp.bytes_read, dp.unknown_words, iterations, loss_sum, dp.metrics.snapshot(),
+                          True))
+    except Exception:
+        report_queue.put((worker_id, traceback.format_exc()))
+
+
+def _get_report(report_queue, processes, finished):
+    """
+    :param finished: ids of workers which reported the end of their shard
+    :return: next report of a worker, raises RuntimeError if a worker exited without reporting the end
+    """
+    while True:
+        # Workers are checked before waiting, reports of those which already exited are in the queue
+        exited = [i for i, p in enumerate(processes) if not p.is_alive() and i not in finished]
+        try:
+            return report_queue.get(timeout=REPORT_TIMEOUT)
+        except queue.Empty:
+            if exited:
+                raise RuntimeError(f"Hogwild worker {exited[0]} exited with code {processes[exited[0]].exitcode} "
+                                   f"without reporting the end of its shard")
+
+
+def train_hogwild(model, workers, report_step=100, previously_read=0, epoch=0):
+    """
+    Hogwild training on CPU. Embedding matrices are moved into shared memory and each of the worker processes
+    trains on its own byte range of the corpus with lock-free sparse updates. The optimizer has to be stateless
+    (SparseSGD, see Word2Vec.create_optimizer), each worker decays the learning rate by its own progress.
+    The parent process aggregates loss and progress, and runs validation and logging as the ordinary training loop.
+    :return: total number of bytes read
+    """
+    model.share_memory()
+    if hasattr(model.optimizer, "share_memory"):
+        model.optimizer.share_memory()
+    ctx = mp.get_context("fork")
+    report_queue = ctx.Queue()
+    shards = model.dp.create_corpus_shards(workers)
+    processes = []
+    for worker_id, shard in enumerate(shards):
+        p = ctx.Process(target=_train_worker,
+                        args=(model, worker_id, shard, np.random.randint(2 ** 31), report_queue, report_step, len(shards),
+                              previously_read),
+                        daemon=True)
+        p.start()
+        processes.append(p)
+
+    bytes_read = [0] * workers
+    unknown_words = [0] * workers
+    metrics_snapshots = [({}, {})] * workers
+    finished = set()
+    iteration = 0
+    try:
+        while len(finished) < workers:
+            t = time.time()
+            report = _get_report(report_queue, processes, finished)
+            model.dp.time_waiting_for_data += time.time() - t
+            if len(report) == 2:
+                raise RuntimeError(f"Hogwild worker {report[0]} failed:\n{report[1]}")
+            worker_id, bytes_read[worker_id], unknown_words[worker_id], iterations, loss_sum, snapshot, done = report
+            if done:
+                finished.add(worker_id)
+            model.dp.metrics.add_snapshot_delta(metrics_snapshots[worker_id], snapshot)
+            metrics_snapshots[worker_id] = snapshot
+            model.dp.bytes_read = sum(bytes_read)
+            model.dp.unknown_words = sum(unknown_words)
+            if not iterations:
+                continue
+            loss = torch.tensor(loss_sum / iterations)
+            model.dp.report_throughput(iterations)
+            for i in range(iteration, iteration + iterations):
+                model.validate_and_log_step(epoch, loss, i, previously_read=previously_read)
+            iteration += iterations
+    finally:
+        for p in processes:
+            p.join(timeout=1.)
+            if p.is_alive():
+                p.terminate()
+    model.log_epoch_end(epoch, iteration)
+    logging.info(f"Hogwild training with {workers} workers done.")
+    return model.dp.bytes_read + previously_read
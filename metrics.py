@@ -0,0 +1,105 @@
+import json
+import logging
+import socket
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Records are written by this logger, see metrics_fhandler in configurations/logging.yml
+METRICS_LOGGER = "metrics"
+HOST = socket.gethostname()
+
+# Stages not counted into training time
+EVAL_STAGES = ("sanity_check", "eval_analogy", "eval_wordsim", "visdom", "tensorboard", "checkpoint")
+
+_END = object()
+
+
+class Metrics:
+    """
+    Per-stage timers and throughput counters of training.
+    Stage times are exclusive, time of a stage nested into another one is subtracted from the outer stage.
+    Timers can be used from several threads (i.e. prefetch threads), each thread keeps its own stack of stages.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        self.seconds = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.start = time.time()
+        self.last_time, self.last_counts = self.start, {}
+
+    @contextmanager
+    def timed(self, stage):
+        stack = self.local.__dict__.setdefault("stack", [])
+        start = time.perf_counter()
+        stack.append(0.)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.seconds[stage] += elapsed - stack.pop()
+            if stack:
+                stack[-1] += elapsed
+
+    def timed_iter(self, iterable, stage):
+        """
+        Iterates over iterable, time spent in producing its items is counted into stage.
+        """
+        it = iter(iterable)
+        while True:
+            with self.timed(stage):
+                item = next(it, _END)
+            if item is _END:
+                return
+            yield item
+
+    def count(self, name, n):
+        self.counts[name] += n
+
+    def snapshot(self):
+        return dict(self.seconds), dict(self.counts)
+
+    def add_snapshot_delta(self, previous, current):
+        """
+        Adds difference of two snapshots taken elsewhere (i.e. in a worker process).
+        """
+        for total, prev, cur in zip((self.seconds, self.counts), previous, current):
+            for k, v in cur.items():
+                total[k] += v - prev.get(k, 0)
+
+    def validation_seconds(self):
+        return sum(self.seconds[stage] for stage in EVAL_STAGES)
+
+    def training_seconds(self):
+        return max(time.time() - self.start - self.validation_seconds(), 1e-9)
+
+    def emit(self, **fields):
+        """
+        Writes one JSON record with fields, counters, their rates per second of training time
+        (overall and since the last record) and seconds spent in each stage.
+        """
+        now = time.time()
+        interval = max(now - self.last_time, 1e-9)
+        training_seconds = self.training_seconds()
+        record = {
+            "time": now,
+            "host": HOST,
+            **fields,
+            "training_seconds": training_seconds,
+            "counts": dict(self.counts),
+            "rates": {f"{k}_per_s": v / training_seconds for k, v in self.counts.items()},
+            "interval_rates": {f"{k}_per_s": (v - self.last_counts.get(k, 0)) / interval
+                               for k, v in self.counts.items()},
+            "stage_seconds": dict(self.seconds)
+        }
+        self.last_time, self.last_counts = now, dict(self.counts)
+        logging.getLogger(METRICS_LOGGER).info(json.dumps(record))
+        return record
+
+    def slowest_stages(self, n=3):
+        return sorted(self.seconds.items(), key=lambda kv: -kv[1])[:n]
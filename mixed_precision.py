@@ -0,0 +1,71 @@
+import torch
+
+EMBEDDING_DTYPES = {
+    "float32": torch.float32,
+    "float16": torch.float16,
+    "bfloat16": torch.bfloat16
+}
+
+
+def stochastic_round(x, dtype):
+    """
+    Rounds float32 tensor x to dtype, up or down with probability proportional to the distance
+    to the neighbouring representable values, so the rounding error is zero in expectation
+    and small updates are not lost.
+    """
+    finfo = torch.finfo(dtype)
+    # Distance between neighbouring values of dtype around x, x = m * 2^e with m in [0.5, 1)
+    _, e = torch.frexp(x)
+    spacing = torch.pow(2., (e - 1).float()) * finfo.eps
+    # Subnormal numbers have constant spacing
+    spacing.clamp_(min=finfo.tiny * finfo.eps)
+    rounded = torch.floor(x / spacing + torch.rand_like(x)) * spacing
+    return rounded.clamp_(finfo.min, finfo.max).to(dtype)
+
+
+class MasterWeightsOptimizer:
+    """
+    Keeps float32 master copies of low precision parameters and runs the wrapped optimizer on them.
+    Gradients are copied to the master parameters before the step, updated rows are rounded back afterwards.
+    Other attributes (param_groups, decay, ...) are taken from the wrapped optimizer.
+    """
+
+    def __init__(self, params, optimizer_cls, **kwargs):
+        self.params = list(params)
+        self.master_params = [p.detach().float().requires_grad_() for p in self.params]
+        self.optimizer = optimizer_cls(self.master_params, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__["optimizer"], name)
+
+    def share_memory(self):
+        # Hogwild workers have to update the same master copies
+        for m in self.master_params:
+            m.data.share_memory_()
+
+    def state_dict(self):
+        return {"optimizer": self.optimizer.state_dict(), "master_params": self.master_params}
+
+    @torch.no_grad()
+    def load_state_dict(self, state_dict):
+        self.optimizer.load_state_dict(state_dict["optimizer"])
+        for m, saved in zip(self.master_params, state_dict["master_params"]):
+            m.copy_(saved)
+
+    def zero_grad(self):
+        for p in self.params + self.master_params:
+            p.grad = None
+
+    @torch.no_grad()
+    def step(self):
+        for p, m in zip(self.params, self.master_params):
+            m.grad = p.grad.float() if p.grad is not None else None
+        self.optimizer.step()
+        for p, m in zip(self.params, self.master_params):
+            if p.grad is None:
+                continue
+            if p.grad.is_sparse:
+                rows = p.grad._indices()[0]
+                p[rows] = m[rows].to(p.dtype)
+            else:
+                p.copy_(m)
@@ -0,0 +1,156 @@
+import argparse
+import logging
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from embedding_io import load_embeddings
+
+# Number of rows scored against the centroids at once while building the index
+BLOCK_SIZE = 65536
+
+
+class ExactNearest:
+    """
+    Exact cosine k-NN over the embedding matrix being trained.
+    The matrix is given as (first row id, weight) blocks (see sharded_embedding.embedding_blocks), each block
+    is searched on its own device and the best rows of the blocks are merged, so shards are never gathered.
+    The normalized blocks are cached and computed again only after the training step changes.
+    """
+
+    def __init__(self):
+        self.step = None
+        self.nblocks = None
+
+    def normalized(self, blocks, step):
+        if step != self.step:
+            self.nblocks = [(start, F.normalize(weight.detach().float())) for start, weight in blocks]
+            self.step = step
+        return self.nblocks
+
+    def search(self, blocks, queries, k, step):
+        """
+        :param queries: embeddings of shape [n, dim]
+        :return: tuple (scores, ids) of k nearest rows for each query, both of shape [n, k]
+        """
+        queries = queries.detach().float()
+        scores, ids = [], []
+        for start, nembs in self.normalized(blocks, step):
+            dist = torch.matmul(queries.to(nembs.device), nembs.t())
+            block_scores, block_ids = torch.topk(dist, dim=1, k=min(k, len(nembs)))
+            scores.append(block_scores.to(queries.device))
+            ids.append(block_ids.to(queries.device) + start)
+        if len(scores) == 1:
+            return scores[0], ids[0]
+        scores, best = torch.topk(torch.cat(scores, dim=1), dim=1, k=k)
+        return scores, torch.gather(torch.cat(ids, dim=1), 1, best)
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def assign(vectors, centroids):
+    """
+    :return: index of the nearest centroid of each vector, scored in blocks of BLOCK_SIZE vectors,
+             so the [n, nlist] score matrix is never created as a whole
+    """
+    return np.concatenate([np.argmax(vectors[i:i + BLOCK_SIZE] @ centroids.T, axis=1)
+                           for i in range(0, len(vectors), BLOCK_SIZE)])
+
+
+class IVFIndex:
+    """
+    Approximate cosine k-NN index with inverted file (IVF).
+    Normalized vectors are clustered by spherical k-means into nlist lists, a query is scored exactly
+    against vectors of the nprobe lists with the nearest centroids only.
+    Ids are stored ordered by list, so ids of each list are contiguous. The index does not keep its own copy
+    of the vectors, candidate rows are gathered from the embedding matrix (i.e. memory-mapped .npy) and normalized
+    when a query is scored.
+    """
+
+    def __init__(self, centroids, ids, offsets, vectors, nprobe=8):
+        self.centroids = centroids
+        self.ids = ids
+        self.offsets = offsets
+        self.vectors = vectors
+        self.nprobe = nprobe
+
+    @classmethod
+    def build(cls, vectors, nlist=None, nprobe=8, iterations=10, seed=0):
+        vectors = normalize(vectors)
+        n = len(vectors)
+        nlist = min(nlist or max(int(4 * np.sqrt(n)), 1), n)
+        rng = np.random.RandomState(seed)
+        # Centroids are trained on a sample, 64 vectors per list are plenty
+        sample = vectors[rng.choice(n, size=min(n, 64 * nlist), replace=False)]
+        centroids = sample[rng.choice(len(sample), size=nlist, replace=False)]
+        for _ in range(iterations):
+            assignment = assign(sample, centroids)
+            # Vectors sorted by list are summed per list with one reduceat
+            order = np.argsort(assignment, kind="stable")
+            counts = np.bincount(assignment, minlength=nlist)
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+            # Empty lists keep their centroid
+            sums = centroids.copy()
+            filled = counts > 0
+            sums[filled] = np.add.reduceat(sample[order], starts[filled], axis=0)
+            centroids = normalize(sums)
+
+        assignment = assign(vectors, centroids)
+        ids = np.argsort(assignment, kind="stable")
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(assignment, minlength=nlist))))
+        logging.info(f"Built IVF index of {n} vectors with {nlist} lists")
+        return cls(centroids, ids, offsets, vectors, nprobe=nprobe)
+
+    def search(self, queries, k=10, nprobe=None):
+        """
+        :param queries: float32 array of shape [n, dim]
+        :return: tuple (scores, ids) of k nearest vectors for each query, both of shape [n, k],
+                 missing neighbours have id -1 and score -inf
+        """
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        queries = normalize(np.atleast_2d(queries))
+        probes = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        for q, (query, lists) in enumerate(zip(queries, probes)):
+            # Candidate ids are sorted, so rows of memory-mapped vectors are read in file order
+            candidates = np.sort(self.ids[np.concatenate([np.arange(self.offsets[l], self.offsets[l + 1])
+                                                          for l in lists])])
+            candidate_scores = normalize(self.vectors[candidates]) @ query
+            top = min(k, len(candidates))
+            best = np.argpartition(-candidate_scores, top - 1)[:top] if top else candidates[:0]
+            best = best[np.argsort(-candidate_scores[best])]
+            scores[q, :top] = candidate_scores[best]
+            ids[q, :top] = candidates[best]
+        return scores, ids
+
+    def save(self, path):
+        np.savez(path, centroids=self.centroids, ids=self.ids, offsets=self.offsets, nprobe=self.nprobe)
+
+    @classmethod
+    def load(cls, path, vectors):
+        """
+        :param vectors: embedding matrix the index was built of, row i is the vector of id i
+        """
+        index = np.load(path)
+        if len(index["ids"]) != len(vectors):
+            raise ValueError(f"Index {path} was built of {len(index['ids'])} vectors, got {len(vectors)}.")
+        return cls(index["centroids"], index["ids"], index["offsets"], vectors, nprobe=int(index["nprobe"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Builds approximate nearest neighbour index of exported embeddings")
+    parser.add_argument("-e", "--embeddings", help="exported embeddings (.vec, .bin or .npy)", required=True)
+    parser.add_argument("-o", "--output", help="where to save the index (.npz)", required=True)
+    parser.add_argument("--nlist", help="number of inverted lists, 4*sqrt(vocabulary size) by default", default=None)
+    parser.add_argument("--nprobe", help="number of lists scored for each query", default=8)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    _, vectors = load_embeddings(args.embeddings)
+    IVFIndex.build(vectors, nlist=int(args.nlist) if args.nlist else None, nprobe=int(args.nprobe)).save(args.output)
@@ -0,0 +1,96 @@
+import numpy as np
+import torch
+
+
+def unigram_distribution(frequencies, power=0.75):
+    """
+    Creates proper unigram distribution raised on 3/4 from word frequencies ordered by word id.
+    """
+    pow_frequency = np.asarray(frequencies, dtype=np.float64) ** power
+    return pow_frequency / pow_frequency.sum()
+
+
+class NegativeSampler:
+    """
+    Draws negative samples from unigram distribution raised on 3/4.
+    Should be overridden by all samplers.
+    """
+
+    def __init__(self, frequencies, nsamples):
+        self.nsamples = nsamples
+        self.probs = unigram_distribution(frequencies)
+
+    def to(self, device):
+        return self
+
+    def sample(self, batch_size):
+        """
+        :return: LongTensor of word ids with shape [batch_size, nsamples]
+        """
+        raise NotImplementedError
+
+
+class AliasSampler(NegativeSampler):
+    """
+    Walker's alias method (Vose's variant), O(V) table construction and O(1) per sample.
+    Each table cell i is kept with probability prob[i], otherwise its alias[i] is sampled.
+    """
+
+    def __init__(self, frequencies, nsamples):
+        super().__init__(frequencies, nsamples)
+        vocab_size = len(self.probs)
+        scaled = self.probs * vocab_size
+        prob = np.ones(vocab_size, dtype=np.float64)
+        alias = np.arange(vocab_size, dtype=np.int64)
+
+        small = np.flatnonzero(scaled < 1.).tolist()
+        large = np.flatnonzero(scaled >= 1.).tolist()
+        scaled = scaled.tolist()
+        while small and large:
+            s, l = small.pop(), large.pop()
+            prob[s] = scaled[s]
+            alias[s] = l
+            scaled[l] = scaled[l] + scaled[s] - 1.
+            if scaled[l] < 1.:
+                small.append(l)
+            else:
+                large.append(l)
+        # Remaining cells are full up to numerical error, they keep prob 1
+
+        self.prob = prob
+        self.alias = alias
+
+    def sample(self, batch_size):
+        size = (batch_size, self.nsamples)
+        cells = np.random.randint(0, len(self.prob), size=size, dtype=np.int64)
+        keep = np.random.random_sample(size) < self.prob[cells]
+        return torch.from_numpy(np.where(keep, cells, self.alias[cells]))
+
+
+class MultinomialSampler(NegativeSampler):
+    """
+    Draws negative samples with torch.multinomial directly on the device the model is trained on.
+    """
+    # Limit of torch.multinomial
+    MAX_CATEGORIES = 2 ** 24
+
+    def __init__(self, frequencies, nsamples):
+        super().__init__(frequencies, nsamples)
+        if len(self.probs) > self.MAX_CATEGORIES:
+            raise ValueError(f"Multinomial sampler supports at most {self.MAX_CATEGORIES} words, "
+                             f"use alias sampler instead.")
+        self.weights = torch.from_numpy(self.probs).float()
+
+    def to(self, device):
+        self.weights = self.weights.to(device)
+        return self
+
+    def sample(self, batch_size):
+        samples = torch.multinomial(self.weights, batch_size * self.nsamples, replacement=True)
+        return samples.view(batch_size, self.nsamples)
+
+
+NEGATIVE_SAMPLERS = {
+    "alias": AliasSampler,
+    "multinomial": MultinomialSampler
+}
@@ -0,0 +1,188 @@
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+from collections import Counter
+
+from corpus import corpus_shards, read_word_lists_range
+from vocab import prune_counts
+
+# Phrases of the current pass, set in each rewriting worker process by _init_rewrite_worker
+_phrases = None
+
+
+def count_bigrams(corpus, start, end, bytes_to_read=1 << 20, max_size=0):
+    """
+    Counts words and pairs of adjacent words in byte range [start, end) of the corpus in one pass.
+    :param max_size: maximum number of distinct words and of distinct bigrams kept during counting, 0 for no limit
+    :return: tuple (unigram counts, bigram counts, number of words), bigrams are keyed by tuples of words
+    """
+    unigrams, bigrams = Counter(), Counter()
+    min_reduce_unigrams = min_reduce_bigrams = 1
+    train_words = 0
+    last = None
+    for wlist, _ in read_word_lists_range(corpus, start, end, bytes_to_read=bytes_to_read):
+        if not wlist:
+            continue
+        unigrams.update(wlist)
+        # The last word of the previous list forms a bigram with the first word of this one
+        words = wlist if last is None else [last] + wlist
+        bigrams.update(zip(words, words[1:]))
+        train_words += len(wlist)
+        last = wlist[-1]
+        min_reduce_unigrams = prune_counts(unigrams, max_size, min_reduce_unigrams)
+        min_reduce_bigrams = prune_counts(bigrams, max_size, min_reduce_bigrams)
+    return unigrams, bigrams, train_words
+
+
+def _count_shard(args):
+    return count_bigrams(*args)
+
+
+def find_phrases(corpus, threshold=100., min_count=5, workers=1, bytes_to_read=1 << 20, max_size=0):
+    """
+    Counts the corpus in parallel and scores its bigrams as in word2phrase,
+    score(a, b) = (count(a b) - min_count) / (count(a) * count(b)) * number of words.
+    :param max_size: maximum number of distinct words and of distinct bigrams kept during counting and merging,
+                     0 for no limit. Counts of rare bigrams are approximate when pruning takes place.
+    :return: set of (a, b) bigrams scoring above threshold
+    """
+    shards = [(corpus, start, end, bytes_to_read, max_size) for start, end in corpus_shards(corpus, workers)]
+    unigrams, bigrams = Counter(), Counter()
+    min_reduce_unigrams = min_reduce_bigrams = 1
+    train_words = 0
+    with multiprocessing.Pool(workers) as pool:
+        for shard_unigrams, shard_bigrams, shard_words in pool.imap_unordered(_count_shard, shards):
+            unigrams.update(shard_unigrams)
+            bigrams.update(shard_bigrams)
+            train_words += shard_words
+            min_reduce_unigrams = prune_counts(unigrams, max_size, min_reduce_unigrams)
+            min_reduce_bigrams = prune_counts(bigrams, max_size, min_reduce_bigrams)
+
+    phrases = set()
+    for (a, b), count in bigrams.items():
+        count_a, count_b = unigrams.get(a, 0), unigrams.get(b, 0)
+        if count < min_count or count_a < min_count or count_b < min_count:
+            continue
+        if (count - min_count) / (count_a * count_b) * train_words > threshold:
+            phrases.add((a, b))
+    return phrases
+
+
+def merge_phrases(wlist, phrases):
+    """
+    Joins adjacent words forming a phrase with underscore, i.e. [new, york] becomes [new_york].
+    Words are merged greedily from left, each word is part of at most one phrase.
+    """
+    merged = []
+    i = 0
+    while i < len(wlist):
+        if i + 1 < len(wlist) and (wlist[i], wlist[i + 1]) in phrases:
+            merged.append(f"{wlist[i]}_{wlist[i + 1]}")
+            i += 2
+        else:
+            merged.append(wlist[i])
+            i += 1
+    return merged
+
+
+def _init_rewrite_worker(phrases):
+    global _phrases
+    _phrases = phrases
+
+
+def _rewrite_shard(args):
+    corpus, start, end, output, bytes_to_read = args
+    merged_words = 0
+    with open(output, "w", encoding="utf-8") as f:
+        carry = []
+        for wlist, _ in read_word_lists_range(corpus, start, end, bytes_to_read=bytes_to_read):
+            words = carry + wlist
+            merged = merge_phrases(words, _phrases)
+            merged_words += len(words) - len(merged)
+            # The last word may start a phrase continuing in the next list, it is merged together with that list
+            carry = [merged.pop()] if merged and merged[-1] == words[-1] else []
+            if merged:
+                f.write(" ".join(merged) + "\n")
+        if carry:
+            f.write(carry[0] + "\n")
+    return merged_words
+
+
+def rewrite_corpus(corpus, output, phrases, workers=1, bytes_to_read=1 << 20):
+    """
+    Writes the corpus with phrases merged into output. Each worker rewrites its own byte range of the corpus
+    into a part file, parts are concatenated afterwards. Line breaks of the corpus are not kept,
+    every chunk of bytes_to_read bytes becomes one line.
+    :return: number of words merged into phrases
+    """
+    shards = corpus_shards(corpus, workers)
+    parts = [f"{output}.part{i}" for i in range(len(shards))]
+    with multiprocessing.Pool(workers, initializer=_init_rewrite_worker, initargs=(phrases,)) as pool:
+        merged_words = sum(pool.map(_rewrite_shard, [(corpus, start, end, part, bytes_to_read)
+                                                     for (start, end), part in zip(shards, parts)]))
+    with open(output, "wb") as f:
+        for part in parts:
+            with open(part, "rb") as p:
+                shutil.copyfileobj(p, f)
+            os.remove(part)
+    return merged_words
+
+
+def phrase_corpus_path(corpus, passes=2, threshold=100., min_count=5):
+    """
+    :return: default path of the phrase corpus, named by parameters of phrase detection
+    """
+    return f"{corpus}.phrases_p{passes}_t{threshold:g}_m{min_count}"
+
+
+def params_path(path):
+    return f"{path}.params"
+
+
+def phrase_params(corpus, passes, threshold, min_count, max_size):
+    return dict(corpus=os.path.abspath(corpus), corpus_size=os.path.getsize(corpus), passes=passes,
+                threshold=threshold, min_count=min_count, max_size=max_size)
+
+
+def is_phrase_corpus(path, corpus, passes=2, threshold=100., min_count=5, max_size=0):
+    """
+    :return: True if path is a complete phrase corpus of the corpus built with the same parameters
+    """
+    try:
+        with open(params_path(path)) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return os.path.exists(path) and saved == phrase_params(corpus, passes, threshold, min_count, max_size)
+
+
+def build_phrase_corpus(corpus, output, passes=2, threshold=100., min_count=5, workers=1, bytes_to_read=1 << 20,
+                        max_size=0):
+    """
+    Runs passes of phrase detection, each pass rewrites the output of the previous one,
+    so phrases of more than two words (i.e. new_york_times) are formed in later passes.
+    The output is written into a temporary file renamed when it is complete, parameters of the detection
+    are saved next to it afterwards (see is_phrase_corpus), so an interrupted run is never reused.
+    :return: path of the rewritten corpus
+    """
+    if os.path.exists(params_path(output)):
+        os.remove(params_path(output))
+    source = corpus
+    for p in range(passes):
+        phrases = find_phrases(source, threshold=threshold, min_count=min_count, workers=workers,
+                               bytes_to_read=bytes_to_read, max_size=max_size)
+        target = f"{output}.tmp" if p == passes - 1 else f"{output}.pass{p}"
+        merged_words = rewrite_corpus(source, target, phrases, workers=workers, bytes_to_read=bytes_to_read)
+        logging.info(f"Phrase pass {p + 1}/{passes}: found {len(phrases)} phrases, merged {merged_words} words")
+        if source != corpus:
+            os.remove(source)
+        source = target
+    if source == corpus:
+        source = f"{output}.tmp"
+        shutil.copyfile(corpus, source)
+    os.replace(source, output)
+    with open(params_path(output), "w") as f:
+        json.dump(phrase_params(corpus, passes, threshold, min_count, max_size), f)
+    return output
@@ -0,0 +1,131 @@
+import copy
+import queue
+import threading
+import traceback
+
+import numpy as np
+import torch.multiprocessing as mp
+
+# Seconds to wait for a batch before checking that workers are still alive
+QUEUE_TIMEOUT = 1.
+
+
+class _WorkerFinished:
+    def __init__(self, worker_id, error=None):
+        self.worker_id = worker_id
+        self.error = error
+
+
+def _produce(data_proc, worker_id, seed, batch_queue, stop):
+    """
+    Runs the batch generator of data_proc and pushes its batches, already turned into tensors, into batch_queue.
+    Each item is a tuple (worker_id, bytes read by this worker, unknown words seen by this worker, batch).
+    """
+    try:
+        # Forked processes would otherwise share the same random state
+        np.random.seed(seed)
+        for batch in data_proc.create_batch_gen():
+            item = (worker_id, data_proc.bytes_read, data_proc.unknown_words, data_proc.batch_to_tensors(batch))
+            while not stop.is_set():
+                try:
+                    batch_queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if stop.is_set():
+                return
+        batch_queue.put(_WorkerFinished(worker_id))
+    except BaseException:
+        # Forwarded to the consumer, which would wait for the end of this worker otherwise
+        batch_queue.put(_WorkerFinished(worker_id, error=traceback.format_exc()))
+    # Tensors are shared with the consumer via this process, keep it alive until the consumer is done
+    stop.wait()
+
+
+class BatchPrefetcher:
+    """
+    Producer-consumer batch pipeline.
+    Worker threads or processes run the batch generator of DataProcessor and push ready-made tensors
+    into a bounded queue, so corpus reading, subsampling and batch creation overlap with the optimization step.
+    With more than one worker, each worker reads its own byte range of the corpus.
+
+    Iterating over the prefetcher yields batches in order in which they became ready, data_proc.bytes_read
+    and data_proc.unknown_words are kept as the sums over all workers.
+    Errors of workers are raised in the consumer, as is the exit of a worker which did not report its end
+    (i.e. killed process), so training never waits for batches which will not come.
+    """
+
+    def __init__(self, data_proc, workers=1, depth=32, mode="thread"):
+        self.dp = data_proc
+        self.workers = workers
+        self.depth = depth
+        self.mode = mode
+        self.bytes_read = [0] * workers
+        self.unknown_words = [0] * workers
+        self.handles = []
+
+    def start(self):
+        if self.mode == "process":
+            # fork, so the workers do not need to pickle the data processor
+            ctx = mp.get_context("fork")
+            self.queue = ctx.Queue(self.depth)
+            self.stop = ctx.Event()
+            create_worker = ctx.Process
+        else:
+            self.queue = queue.Queue(self.depth)
+            self.stop = threading.Event()
+            create_worker = threading.Thread
+        shards = self.dp.create_corpus_shards(self.workers) if self.workers > 1 else [None]
+        for worker_id, shard in enumerate(shards):
+            # Every worker has its own copy of generator state (random windows, bytes read)
+            worker_dp = copy.copy(self.dp)
+            worker_dp.corpus_range = shard
+            handle = create_worker(target=_produce,
+                                   args=(worker_dp, worker_id, np.random.randint(2 ** 31), self.queue, self.stop),
+                                   daemon=True)
+            handle.start()
+            self.handles.append(handle)
+
+    def get(self, finished):
+        """
+        :param finished: ids of workers which reported their end
+        :return: next item of the queue
+        """
+        while True:
+            # Workers stay alive until close, those which exited before waiting have their last item in the queue
+            exited = [i for i, handle in enumerate(self.handles) if not handle.is_alive() and i not in finished]
+            try:
+                return self.queue.get(timeout=QUEUE_TIMEOUT)
+            except queue.Empty:
+                if exited:
+                    exitcode = getattr(self.handles[exited[0]], "exitcode", None)
+                    raise RuntimeError(f"Prefetch worker {exited[0]} exited without reporting its end"
+                                       + (f", exit code {exitcode}" if exitcode is not None else ""))
+
+    def close(self):
+        self.stop.set()
+        for handle in self.handles:
+            handle.join(timeout=1.)
+            if self.mode == "process" and handle.is_alive():
+                handle.terminate()
+        self.handles = []
+
+    def __iter__(self):
+        self.start()
+        finished = set()
+        try:
+            while len(finished) < len(self.handles):
+                item = self.get(finished)
+                if isinstance(item, _WorkerFinished):
+                    if item.error is not None:
+                        raise RuntimeError(f"Prefetch worker {item.worker_id} failed:\n{item.error}")
+                    finished.add(item.worker_id)
+                    continue
+                worker_id, bytes_read, unknown_words, batch = item
+                self.bytes_read[worker_id] = bytes_read
+                self.unknown_words[worker_id] = unknown_words
+                self.dp.bytes_read = sum(self.bytes_read)
+                self.dp.unknown_words = sum(self.unknown_words)
+                yield batch
+        finally:
+            self.close()
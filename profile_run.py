@@ -0,0 +1,85 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import shutil
+import subprocess
+import time
+
+import torch
+from torch.profiler import profile, ProfilerActivity
+
+
+def write_call_graph(pstats_path, svg_path):
+    """
+    Renders call graph of the profile with gprof2dot and graphviz, if they are installed.
+    """
+    if shutil.which("gprof2dot") is None or shutil.which("dot") is None:
+        logging.warning(f"gprof2dot or graphviz is not installed, render the call graph with "
+                        f"'gprof2dot -f pstats {pstats_path} | dot -Tsvg -o {svg_path}'")
+        return
+    dot = subprocess.run(["gprof2dot", "-f", "pstats", pstats_path], check=True, capture_output=True).stdout
+    subprocess.run(["dot", "-Tsvg", "-o", svg_path], input=dot, check=True)
+
+
+def profile_training(model, iterations, run_dir, top=25):
+    """
+    Runs at most iterations training steps under cProfile and torch profiler.
+    Writes into run_dir python.pstats with its call graph python.svg, Chrome trace torch_trace.json
+    (open it in chrome://tracing) and summary.txt with top entries of both profiles, which is printed too.
+    """
+    os.makedirs(run_dir, exist_ok=True)
+    dp = model.dp
+    dp.init_benchmark()
+    batch_gen = dp.create_prefetched_batch_gen()
+
+    activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if model.use_cuda else [])
+    python_profile = cProfile.Profile()
+    steps = 0
+    t = time.time()
+    with profile(activities=activities, record_shapes=True) as torch_profile:
+        python_profile.enable()
+        for batch in batch_gen:
+            model.train_step(batch)
+            dp.report_throughput()
+            steps += 1
+            if steps == iterations:
+                break
+        if model.use_cuda:
+            torch.cuda.synchronize()
+        python_profile.disable()
+    elapsed = time.time() - t
+    # Stop prefetch workers
+    batch_gen.close()
+
+    pstats_path = os.path.join(run_dir, "python.pstats")
+    python_profile.dump_stats(pstats_path)
+    write_call_graph(pstats_path, os.path.join(run_dir, "python.svg"))
+    torch_profile.export_chrome_trace(os.path.join(run_dir, "torch_trace.json"))
+
+    python_summary = io.StringIO()
+    pstats.Stats(python_profile, stream=python_summary).sort_stats("cumulative").print_stats(top)
+    sort_by = "self_cuda_time_total" if model.use_cuda else "self_cpu_time_total"
+    summary = (f"Profiled {steps} iterations of {dp.modelname} in {elapsed:.2f} s "
+               f"({steps * dp.batch_size / elapsed:.0f} pairs/s)\n\n"
+               f"Python data path, top {top} functions by cumulative time:\n{python_summary.getvalue()}\n"
+               f"Model operators, top {top} by self time:\n"
+               f"{torch_profile.key_averages().table(sort_by=sort_by, row_limit=top)}\n")
+    with open(os.path.join(run_dir, "summary.txt"), "w") as f:
+        f.write(summary)
+    print(summary)
+    logging.info(f"Profile written to {run_dir}")
+
+
+def init_argparser_profile(parser):
+    parser.add_argument("--profile", help="profile bounded number of training iterations instead of training",
+                        action="store_true")
+    parser.add_argument("--profile_iterations", help="number of iterations to profile", default=200)
+    parser.add_argument("--profile_dir", help="directory to write profiles into (default: profiling/<model>_<time>)")
+    parser.add_argument("--profile_top", help="number of entries in the summary tables", default=25)
+
+
+def run_profile(model, args):
+    run_dir = args.profile_dir or os.path.join("profiling", f"{model.dp.modelname}_{time.strftime('%Y%m%d-%H%M%S')}")
+    profile_training(model, int(args.profile_iterations), run_dir, top=int(args.profile_top))
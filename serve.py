@@ -0,0 +1,219 @@
+import argparse
+import json
+import logging
+import os
+import socket
+import socketserver
+import time
+from functools import lru_cache
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+
+from embedding_io import export_format, load_embeddings, read_npy, write_npy
+from nearest import IVFIndex, normalize
+
+
+class VocabIndex:
+    """
+    Compact memory-mapped vocabulary index. Words are stored as one utf-8 blob with offsets,
+    their ids sorted by word bytes allow binary search, so no dictionary has to be built on startup.
+    """
+
+    def __init__(self, blob, offsets, order):
+        self.blob = blob
+        self.offsets = offsets
+        self.order = order
+
+    @staticmethod
+    def paths(prefix):
+        return tuple(f"{prefix}.{part}.npy" for part in ("words", "offsets", "order"))
+
+    @classmethod
+    def build(cls, words, prefix):
+        encoded = [w.encode("utf-8") for w in words]
+        blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        offsets = np.concatenate(([0], np.cumsum([len(w) for w in encoded]))).astype(np.int64)
+        order = np.array(sorted(range(len(encoded)), key=encoded.__getitem__), dtype=np.int64)
+        for path, array in zip(cls.paths(prefix), (blob, offsets, order)):
+            np.save(path, array)
+
+    @classmethod
+    def load(cls, prefix):
+        return cls(*(np.load(path, mmap_mode="r") for path in cls.paths(prefix)))
+
+    def __len__(self):
+        return len(self.order)
+
+    def word(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("utf-8")
+
+    def id(self, word):
+        """
+        :return: id of the word, or None if it is not in the vocabulary
+        """
+        key = word.encode("utf-8")
+        lo, hi = 0, len(self.order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            i = self.order[mid]
+            w = self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes()
+            if w == key:
+                return int(i)
+            if w < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+
+def prepare(embeddings_path):
+    """
+    Converts exported embeddings into .npy matrix and vocabulary index next to them, if it was not done before.
+    :return: path of the .npy matrix
+    """
+    base = os.path.splitext(embeddings_path)[0]
+    npy_path = embeddings_path if export_format(embeddings_path) == "npy" else f"{base}.npy"
+    if not os.path.exists(npy_path):
+        logging.info(f"Converting {embeddings_path} into {npy_path}...")
+        write_npy(npy_path, *load_embeddings(embeddings_path))
+    if not all(os.path.exists(p) for p in VocabIndex.paths(os.path.splitext(npy_path)[0])):
+        logging.info(f"Building vocabulary index of {npy_path}...")
+        VocabIndex.build(read_npy(npy_path)[0], os.path.splitext(npy_path)[0])
+    return npy_path
+
+
+class EmbeddingService:
+    """
+    Answers lookups, similarity and k-NN queries over memory-mapped embeddings.
+    Per-word results are kept in LRU caches for hot queries.
+    """
+
+    def __init__(self, npy_path, index_path=None, cache_size=65536):
+        self.vectors = np.load(npy_path, mmap_mode="r")
+        self.vocab = VocabIndex.load(os.path.splitext(npy_path)[0])
+        self.index = IVFIndex.load(index_path, self.vectors) if index_path else None
+        # Normalized matrix for exact k-NN is created on the first query, not on startup
+        self.nembs = None
+        self.id = lru_cache(maxsize=cache_size)(self.vocab.id)
+        self.nearest_word = lru_cache(maxsize=cache_size)(self._nearest_word)
+
+    def vector(self, word):
+        i = self.id(word)
+        return None if i is None else self.vectors[i]
+
+    def lookup(self, words):
+        return {w: (v.tolist() if v is not None else None) for w, v in zip(words, map(self.vector, words))}
+
+    def similarity(self, pairs):
+        result = []
+        for a, b in pairs:
+            u, v = self.vector(a), self.vector(b)
+            if u is None or v is None:
+                result.append(None)
+            else:
+                result.append(float(np.dot(u, v) / max(np.linalg.norm(u) * np.linalg.norm(v), 1e-12)))
+        return result
+
+    def search(self, queries, k):
+        """
+        :return: tuple (scores, ids) of k nearest words for each of the query vectors
+        """
+        if self.index is not None:
+            return self.index.search(queries, k=k)
+        if self.nembs is None:
+            self.nembs = normalize(self.vectors)
+        dist = normalize(queries) @ self.nembs.T
+        ids = np.argpartition(-dist, k - 1, axis=1)[:, :k]
+        ids = np.take_along_axis(ids, np.argsort(-np.take_along_axis(dist, ids, axis=1), axis=1), axis=1)
+        return np.take_along_axis(dist, ids, axis=1), ids
+
+    def _nearest_word(self, word, k):
+        i = self.id(word)
+        if i is None:
+            return None
+        scores, ids = self.search(np.asarray(self.vectors[i:i + 1], dtype=np.float32), k + 1)
+        # The word itself is not its neighbour
+        return tuple((self.vocab.word(j), float(s)) for s, j in zip(scores[0], ids[0]) if j != i and j >= 0)[:k]
+
+    def nearest(self, words, k=10):
+        result = {}
+        for w in words:
+            neighbours = self.nearest_word(w, k)
+            result[w] = [list(n) for n in neighbours] if neighbours is not None else None
+        return result
+
+
+class EmbeddingRequestHandler(BaseHTTPRequestHandler):
+    """
+    JSON API, all requests are POSTs:
+        /vectors    {"words": [...]}              -> {"vectors": {word: [...] or null}}
+        /similarity {"pairs": [[a, b], ...]}      -> {"similarities": [float or null, ...]}
+        /nearest    {"words": [...], "k": 10}     -> {"nearest": {word: [[neighbour, cosine], ...] or null}}
+    """
+
+    def do_POST(self):
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            service = self.server.service
+            if self.path == "/vectors":
+                response = {"vectors": service.lookup(request["words"])}
+            elif self.path == "/similarity":
+                response = {"similarities": service.similarity(request["pairs"])}
+            elif self.path == "/nearest":
+                response = {"nearest": service.nearest(request["words"], int(request.get("k", 10)))}
+            else:
+                return self.reply(404, {"error": f"Unknown endpoint {self.path}"})
+        except (KeyError, TypeError, ValueError) as e:
+            return self.reply(400, {"error": repr(e)})
+        self.reply(200, response)
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Unix socket clients have no host
+        return str(self.client_address[0]) if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        # HTTPServer.server_bind expects (host, port) address
+        socketserver.TCPServer.server_bind(self)
+        self.server_name, self.server_port = "unix", 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serves trained embeddings over local HTTP or Unix socket API")
+    parser.add_argument("-e", "--embeddings",
+                        help="exported embeddings, other formats than .npy are converted to .npy on the first start",
+                        required=True)
+    parser.add_argument("-i", "--index", help="approximate nearest neighbour index built by nearest.py, "
+                                              "exact search is used if not given")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("-p", "--port", default=8080)
+    parser.add_argument("-u", "--unix_socket", help="listen on Unix socket instead of TCP port")
+    parser.add_argument("--cache_size", help="number of cached results of each query type", default=65536)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    t = time.time()
+    service = EmbeddingService(prepare(args.embeddings), index_path=args.index, cache_size=int(args.cache_size))
+    server = UnixHTTPServer(args.unix_socket, EmbeddingRequestHandler) if args.unix_socket \
+        else ThreadingHTTPServer((args.host, int(args.port)), EmbeddingRequestHandler)
+    server.service = service
+    logging.info(f"Serving {len(service.vocab)} words on {args.unix_socket or f'{args.host}:{args.port}'}, "
+                 f"started in {time.time() - t:.2f} s")
+    server.serve_forever()
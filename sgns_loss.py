@@ -0,0 +1,70 @@
+import torch
+import torch.nn.functional as F
+
+
+# Rows of the batch scored at once, so only [CHUNK_SIZE, nsamples+1, dim] context rows are live at any time
+CHUNK_SIZE = 64
+
+
+def chunks(n):
+    return (slice(start, start + CHUNK_SIZE) for start in range(0, n, CHUNK_SIZE))
+
+
+class SGNSLoss(torch.autograd.Function):
+    """
+    Fused skip-gram negative sampling loss
+        -(log o(v^T*u) + sum of k samples log o(-negative_v^T *u)) / batch_size
+    Positive and negative context rows are gathered and scored with bmm in chunks of CHUNK_SIZE rows of the batch,
+    so no [batch, nsamples+1, dim] tensor is ever created. Only the [batch, nsamples+1] score coefficients are kept
+    for backward, which computes the gradient of u embeddings chunk by chunk, and the sparse gradient of the V
+    embedding matrix accumulated into one row for each distinct context word.
+    Low precision V rows are accumulated in float32, the gradient of V matrix is returned in its dtype.
+    """
+
+    @staticmethod
+    def forward(ctx, u_emb, v_weight, pos_v, neg_v, batch_size):
+        # Column 0 holds positive context word, others are negative samples
+        ids = torch.cat((pos_v.unsqueeze(1), neg_v), dim=1)
+        scores = torch.empty(ids.shape, dtype=torch.float32, device=u_emb.device)
+        for rows in chunks(len(ids)):
+            scores[rows] = torch.bmm(v_weight[ids[rows]].float(), u_emb[rows].float().unsqueeze(2)).squeeze(2)
+        scores[:, 1:].neg_()
+        loss = -F.logsigmoid(scores).sum() / batch_size
+
+        # d loss/d score, with sign of negative samples already applied
+        coef = torch.sigmoid(scores).sub_(1.)
+        coef[:, 1:].neg_()
+        ctx.save_for_backward(u_emb, v_weight, ids, coef)
+        ctx.batch_size = batch_size
+        return loss
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        u_emb, v_weight, ids, coef = ctx.saved_tensors
+        g = coef * (grad_output / ctx.batch_size)
+        grad_u = grad_v = None
+        if ctx.needs_input_grad[0]:
+            grad_u = torch.empty(u_emb.shape, dtype=torch.float32, device=u_emb.device)
+            for rows in chunks(len(ids)):
+                grad_u[rows] = torch.bmm(g[rows].unsqueeze(1), v_weight[ids[rows]].float()).squeeze(1)
+            grad_u = grad_u.to(u_emb.dtype)
+        if ctx.needs_input_grad[1]:
+            # Context words repeat across the batch, each distinct one gets a single row of the gradient
+            unique_ids, inverse = torch.unique(ids, return_inverse=True)
+            values = torch.zeros(len(unique_ids), u_emb.shape[1], dtype=torch.float32, device=u_emb.device)
+            for rows in chunks(len(ids)):
+                values.index_add_(0, inverse[rows].reshape(-1),
+                                  (g[rows].unsqueeze(2) * u_emb[rows].float().unsqueeze(1)).view(-1, u_emb.shape[1]))
+            grad_v = torch.sparse_coo_tensor(unique_ids.unsqueeze(0), values.to(v_weight.dtype), v_weight.shape)
+        return grad_u, grad_v, None, None, None
+
+
+def sgns_loss(u_emb, v_weight, pos_v, neg_v, batch_size):
+    """
+    :param u_emb: embeddings of target words (or averaged contexts), shape [batch_size, dim]
+    :param v_weight: weight of V embedding matrix
+    :param pos_v: ids of positive context words, shape [batch_size]
+    :param neg_v: ids of negative samples, shape [batch_size, nsamples]
+    :return: negative sampling loss averaged over the batch
+    """
+    return SGNSLoss.apply(u_emb, v_weight, pos_v, neg_v, batch_size)
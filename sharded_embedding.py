@@ -0,0 +1,129 @@
+import torch
+import torch.nn as nn
+
+
+def shard_boundaries(num_embeddings, fractions):
+    """
+    :return: list of len(fractions) + 1 row boundaries, shard i owns rows [boundaries[i], boundaries[i + 1])
+    """
+    total = sum(fractions)
+    boundaries = [0]
+    cumulative = 0.
+    for fraction in fractions:
+        cumulative += fraction
+        boundaries.append(int(round(num_embeddings * cumulative / total)))
+    boundaries[-1] = num_embeddings
+    return boundaries
+
+
+def embedding_blocks(embedding):
+    """
+    :param embedding: nn.Embedding, nn.EmbeddingBag or ShardedEmbedding
+    :return: list of (first row id, weight) blocks of rows covering the whole matrix, each on its own device
+    """
+    if isinstance(embedding, ShardedEmbedding):
+        return embedding.blocks()
+    return [(0, embedding.weight)]
+
+
+@torch.no_grad()
+def embedding_rows(embedding, ids):
+    """
+    :return: rows of ids as float32, without gathering the whole matrix on one device
+    """
+    if isinstance(embedding, ShardedEmbedding):
+        return embedding.rows(ids).float()
+    return embedding.weight[ids.to(embedding.weight.device)].float()
+
+
+@torch.no_grad()
+def embedding_matrix(embedding):
+    """
+    :return: whole float32 matrix gathered in host memory, used by export
+    """
+    return torch.cat([weight.float().cpu() for _, weight in embedding_blocks(embedding)])
+
+
+class ShardedEmbedding(nn.Module):
+    """
+    Sparse embedding matrix split by rows into shards placed on different devices, i.e. several GPUs and host
+    memory, so the vocabulary is not limited by memory of one device.
+    Looked up ids are routed to the shards owning them, rows are gathered on the shard's device and moved
+    to output_device. Each shard is a sparse nn.Embedding, so the optimizer updates its rows on its own device.
+    With mode="mean" the lookup works as mean nn.EmbeddingBag with offsets.
+    Number of rows looked up in each shard is counted, so with frequency-ordered ids and hot rows in the first
+    shard on device (see Word2Vec.create_embedding), the hit rate of the device tier can be reported.
+    """
+
+    def __init__(self, num_embeddings, embedding_dim, devices, fractions=None, output_device="cpu", mode=None):
+        super(ShardedEmbedding, self).__init__()
+        self.num_embeddings = num_embeddings
+        self.embedding_dim = embedding_dim
+        self.boundaries = shard_boundaries(num_embeddings, fractions if fractions else [1.] * len(devices))
+        self.shards = nn.ModuleList(nn.Embedding(end - start, embedding_dim, sparse=True).to(device)
+                                    for device, start, end in zip(devices, self.boundaries, self.boundaries[1:]))
+        self.output_device = torch.device(output_device)
+        self.mode = mode
+        self.lookups = [0] * len(self.shards)
+
+    def blocks(self):
+        """
+        There is no weight of the whole matrix, evaluation works on the shards one by one (see embedding_blocks).
+        :return: list of (first row id, weight) of the shards
+        """
+        return [(start, shard.weight) for start, shard in zip(self.boundaries, self.shards)]
+
+    @torch.no_grad()
+    def rows(self, ids):
+        """
+        Rows of ids for evaluation, they are not counted into the hit rate.
+        """
+        lookups = list(self.lookups)
+        rows = self.lookup(ids)
+        self.lookups = lookups
+        return rows
+
+    def lookup(self, ids):
+        """
+        :param ids: flat tensor of row ids
+        :return: rows of ids on output_device, shape [len(ids), embedding_dim]
+        """
+        ids = ids.to(self.output_device)
+        # Shard of each id, boundaries are sorted, so shard i holds ids lower than its end boundary
+        shard_ends = torch.tensor(self.boundaries[1:-1], dtype=ids.dtype, device=ids.device)
+        owners = torch.bucketize(ids, shard_ends, right=True)
+        dtype = self.shards[0].weight.dtype
+        rows = torch.empty(len(ids), self.embedding_dim, dtype=dtype, device=self.output_device)
+        for i, shard in enumerate(self.shards):
+            positions = torch.nonzero(owners == i, as_tuple=True)[0]
+            if not len(positions):
+                continue
+            self.lookups[i] += len(positions)
+            local_ids = (ids[positions] - self.boundaries[i]).to(shard.weight.device)
+            shard_rows = shard(local_ids)
+            if shard_rows.device.type == "cpu" and self.output_device.type == "cuda":
+                # Rows gathered in host memory are staged in pinned memory, so they are copied asynchronously
+                shard_rows = shard_rows.pin_memory()
+            rows = rows.index_copy(0, positions, shard_rows.to(self.output_device, non_blocking=True))
+        return rows
+
+    def hit_rate(self):
+        """
+        :return: fraction of rows looked up since the last reset_lookups served by the first shard
+        """
+        return self.lookups[0] / max(sum(self.lookups), 1)
+
+    def reset_lookups(self):
+        self.lookups = [0] * len(self.shards)
+
+    def forward(self, input, offsets=None):
+        rows = self.lookup(input.reshape(-1))
+        if self.mode != "mean":
+            return rows.view(*input.shape, self.embedding_dim)
+        # Mean of rows of each bag, bag i starts at offsets[i]
+        offsets = offsets.to(self.output_device)
+        bags = torch.bucketize(torch.arange(len(rows), device=self.output_device), offsets[1:], right=True)
+        sums = torch.zeros(len(offsets), self.embedding_dim, dtype=rows.dtype, device=self.output_device)
+        sums = sums.index_add(0, bags, rows)
+        counts = torch.bincount(bags, minlength=len(offsets)).clamp(min=1).to(rows.dtype)
+        return sums / counts.unsqueeze(1)
@@ -7,34 +7,33 @@ __modelname__ = "Skipgram"
 __author__ = "Martin Fajčík"
 
 import argparse
+import sys
 import numpy as np
 import torch
 import logging
-import torch.nn as nn
 
-from collections import deque
-from nlpfit.preprocessing.nlp_io import read_word_lists
 from word2vec import init_argparser_general, DataProcessor, Word2Vec, init_logging
+from profile_run import init_argparser_profile, run_profile
 
 
 class Skipgram(Word2Vec):
     def intristric_eval(self):
-        return intrinstric_eval(self.u_embeddings, self.dp.w2id, use_cuda=self.use_cuda)
+        return intrinstric_eval(self.u_embeddings, self.wordsim)
 
     def create_embedding_matrices(self):
         # create U embedding (target word) matrix
-        self.u_embeddings = nn.Embedding(self.dp.vocab_size, self.dp.embedding_size, sparse=True)
+        self.u_embeddings = self.create_embedding()
         # create V embedding (context word) matrix
         if self.dp.share_weights:
             # share weights in case of shared weigts experiment
             self.v_embeddings = self.u_embeddings
         else:
-            self.v_embeddings = nn.Embedding(self.dp.vocab_size, self.dp.embedding_size, sparse=True)
+            self.v_embeddings = self.create_embedding()
         self.init_embeddings(self.u_embeddings, self.v_embeddings)
 
     def forward(self, batch):
         """Forward process.
-        As pytorch designed, all variables must be batch format, so all input of this method is a list of word id.
+        As pytorch designed, all variables must be batch format, so batch is a tuple of word id arrays or tensors.
         Args:
             pos_u: list of center word ids for positive word pairs.
             pos_v: list of neighbor word ids for positive word pairs.
@@ -48,37 +47,19 @@ class Skipgram(Word2Vec):
             neg_v: [batch_size, neg_sampling_count]
         """
 
-        pos_u = torch.LongTensor([pair[0] for pair in batch])
-        pos_v = torch.LongTensor([pair[1] for pair in batch])
-        neg_v = torch.LongTensor(self.dp.get_neg_v_neg_sampling())
+        pos_u = torch.as_tensor(batch[0], dtype=torch.long)
+        pos_v = torch.as_tensor(batch[1], dtype=torch.long)
+        neg_v = self.dp.get_neg_v_neg_sampling()
         if self.use_cuda:
-            pos_u = pos_u.cuda()
-            pos_v = pos_v.cuda()
-            neg_v = neg_v.cuda()
+            with self.dp.metrics.timed("to_device"):
+                pos_u = pos_u.cuda()
+                pos_v = pos_v.cuda()
+                neg_v = neg_v.cuda()
 
-        # pick embeddings for words pos_u, pos_v
+        # pick embeddings for words pos_u
         u_emb_batch = self.u_embeddings(pos_u)
-        v_emb_batch = self.v_embeddings(pos_v)
 
-        # o is sigmoid function
-        # NS loss for 1 sample and max objective is
-        ##########################################################
-        # log o(v^T*u) + sum of k samples log o(-negative_v^T *u)#
-        ##########################################################
-
-        # Multiply element wise
-        score = torch.mul(u_emb_batch, v_emb_batch)
-        # Sum so we get dot product for each row
-        score = torch.sum(score, dim=1)
-        score = self.logsigmoid(score)
-        v_neg_emb_batch = self.v_embeddings(neg_v)
-
-        # v_neg_emb_batch has shape [BATCH_SIZE,NUM_OF_NEG_SAMPLES,EMBEDDING_DIMENSIONALITY]
-        # u_emb_batch has shape [BATCH_SIZE,EMBEDDING_DIMENSIONALITY]
-        neg_score = torch.bmm(v_neg_emb_batch, u_emb_batch.unsqueeze(2))
-        neg_score = self.logsigmoid(-1. * neg_score)
-
-        return -1. * (torch.sum(score) + torch.sum(neg_score)) / self.dp.batch_size
+        return self.negative_sampling_loss(u_emb_batch, pos_v, neg_v)
 
 
 class WordTargetDataProcessor(DataProcessor):
@@ -88,87 +69,78 @@ class WordTargetDataProcessor(DataProcessor):
     """
 
     def create_batch_gen(self):
-        # Create word list generator
-        wordgen = read_word_lists(self.corpus, bytes_to_read=self.bytes_to_read, report_bytesread=True)
-        # Create queue of random choices
-        rchoices = deque(np.random.choice(np.arange(1, self.window_size + 1), self.randints_to_precalculate))
-        # create doubles
-        word_from_last_list = []
-        word_pairs = []
+        # Create word id list generator
+        idgen = self.create_id_list_gen()
+        # Create buffer of random reduced window sizes
+        self.init_reduced_windows()
+        # Word ids kept from the last list, centers from index si on were not processed yet
+        word_from_last_list = np.empty(0, dtype=np.int32)
         si = 0
-        for wlist_ in wordgen:
-            wlist = wlist_[0]
-            self.bytes_read = wlist_[1]
-            # Discard words with min_freq or less occurences
-            # Subsample of Frequent Words
-            # hese words are removed from the text before generating the contexts
-            wlist_clean = []
-            for w in wlist:
-                try:
-                    if not (self.frequency_vocab_with_OOV[w] < self.min_freq or self.should_be_subsampled(w)):
-                        wlist_clean.append(w)
-                except KeyError as e:
-                    logging.error("Encountered unknown word!")
-                    logging.error(e)
-                    logging.error(f"Wlist: {wlist}")
-            wlist = wlist_clean
-
-            # TODO: Phrase clustering here
-            # FIXME: Using small number of bytes like 50 for file reading results into failure, WHY?
-
-            if not wlist:
-                # This happens if we reached the end of dataset
-                # Maybe this is redundant code...
-                while word_from_last_list:
-                    if not rchoices:
-                        rchoices = deque(
-                            np.random.choice(np.arange(1, self.window_size + 1), self.randints_to_precalculate))
-                    r = rchoices.pop()
-                    for i in range(len(word_from_last_list)):
-                        for c in range(-r, r + 1):
-                            if c == 0 or i + c < 0:
-                                continue
-                            elif i + c > len(word_from_last_list) - 1:
-                                break
-                            elif len(word_pairs) == self.batch_size:
-                                word_from_last_list = word_from_last_list[i:]
-                                break
-                            word_pairs.append((word_from_last_list[i], word_from_last_list[i + c]))
-                        if i == len(word_from_last_list) - 1:
-                            word_from_last_list = []
-                    for _ in range(self.batch_size - len(word_pairs)):
-                        word_pairs.append((0, 0))
-                    assert len(word_pairs) == self.batch_size
-                    yield word_pairs
-                return
-
-            wlist = list(map(lambda x: self.w2id[x], wlist))
-            wlist = word_from_last_list + wlist
-            word_from_last_list = []
-            for i in range(si, len(wlist)):
-                if (i + self.window_size > len(wlist) - 1):
-                    # find index m, that points on leftmost word still in a window
-                    # of central word
-                    m = max(i - self.window_size, 0)
-
-                    # save the index of central word, with respect to start at leftmost word at position m
-                    si = i - m
-
-                    # throw away words before leftmost word, they have already been processed
-                    word_from_last_list = wlist[m:]
-                    break
-                if not rchoices:
-                    rchoices = deque(
-                        np.random.choice(np.arange(1, self.window_size + 1), self.randints_to_precalculate))
-                r = rchoices.pop()
-                for c in range(-r, r + 1):
-                    if c == 0 or i + c < 0:
-                        continue
-                    word_pairs.append((wlist[i], wlist[i + c]))
-            if len(word_pairs) > self.batch_size:
-                self.log_epoch_progress()
-                yield word_pairs[:self.batch_size]
-                word_pairs = word_pairs[self.batch_size:]
+        targets = np.empty(0, dtype=np.int32)
+        contexts = np.empty(0, dtype=np.int32)
+        # Words with min_freq or less occurences are discarded and frequent words are subsampled
+        # These words are removed from the text before generating the contexts
+        for wids, bytes_read in idgen:
+            self.bytes_read = bytes_read
+
+            if not len(wids):
+                continue
+
+            wids = np.concatenate((word_from_last_list, wids))
+
+            # Only centers with whole window inside the buffered part are processed now
+            stop = len(wids) - self.window_size
+            if stop > si:
+                with self.metrics.timed("pair_building"):
+                    t, c = self.create_pairs(wids, si, stop)
+                    targets = np.concatenate((targets, t))
+                    contexts = np.concatenate((contexts, c))
+
+            # find index m, that points on leftmost word still in a window
+            # of the first unprocessed central word
+            i = max(si, stop)
+            m = max(i - self.window_size, 0)
+            # save the index of central word, with respect to start at leftmost word at position m
+            si = i - m
+            # throw away words before leftmost word, they have already been processed
+            word_from_last_list = wids[m:]
+
+            while len(targets) >= self.batch_size:
+                yield targets[:self.batch_size], contexts[:self.batch_size]
+                targets = targets[self.batch_size:]
+                contexts = contexts[self.batch_size:]
+
+        # We reached the end of dataset, process the rest of buffered words
+        if si < len(word_from_last_list):
+            t, c = self.create_pairs(word_from_last_list, si, len(word_from_last_list))
+            targets = np.concatenate((targets, t))
+            contexts = np.concatenate((contexts, c))
+        for start in range(0, len(targets), self.batch_size):
+            t = targets[start:start + self.batch_size]
+            c = contexts[start:start + self.batch_size]
+            if len(t) < self.batch_size:
+                # Pad the last batch with (0,0) pairs
+                padding = np.zeros(self.batch_size - len(t), dtype=np.int32)
+                t = np.concatenate((t, padding))
+                c = np.concatenate((c, padding))
+            yield t, c
+
+    def create_pairs(self, wids, start, stop):
+        """
+        Creates all (target, context) pairs for central words wids[start:stop].
+        Each central word i gets its own reduced window r, its contexts are words at positions
+        i-r,...,i-1,i+1,...,i+r lying inside wids. Pairs keep the order of the central words
+        and of the context positions.
+        :return: tuple of int32 arrays (targets, contexts)
+        """
+        centers = np.arange(start, stop)
+        r = self.draw_reduced_windows(len(centers))
+        offsets = np.concatenate((np.arange(-self.window_size, 0), np.arange(1, self.window_size + 1)))
+        positions = centers[:, None] + offsets
+        mask = (np.abs(offsets) <= r[:, None]) & (positions >= 0) & (positions < len(wids))
+        targets = np.broadcast_to(wids[centers, None], positions.shape)[mask]
+        contexts = wids[positions[mask]]
+        return targets, contexts
 
 
 def init_argparser_skipgram(parser):
@@ -177,9 +149,11 @@ def init_argparser_skipgram(parser):
     # Optional arguments with value
     parser.add_argument("-lr", "--learning_rate", help="initial learning rate",
                         default=0.0025
-                        # 10x smaller than used by Tomas Mikolov, because we use SparseAdam, not the SGD
+                        # 10x smaller than used by Tomas Mikolov, because SparseAdam is used by default, not the SGD
                         )
 
+    parser.add_argument("-e", "--epochs", help="number of training epochs", default=100)
+
     ## Step count parameters
     parser.add_argument("--lossreport_step", help="number of steps after which loss value is reported",
                         default=20000)
@@ -204,14 +178,19 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     init_argparser_general(parser)
     init_argparser_skipgram(parser)
+    init_argparser_profile(parser)
     args = parser.parse_args()
     init_logging(args)
 
     with WordTargetDataProcessor(args, __modelname__) as data_proc:
         skipgram_model = Skipgram(data_proc)
-        bytes_read = 0
-        epochs = 100
-        for e in range(epochs):
+        if args.profile:
+            run_profile(skipgram_model, args)
+            sys.exit()
+        start_epoch, bytes_read = skipgram_model.resume() if args.resume else (0, 0)
+        epochs = data_proc.epochs
+        for e in range(start_epoch, epochs):
             logging.info(f"Starting epoch: {e}")
             bytes_read = skipgram_model._train(previously_read=bytes_read, epoch=e)
-        skipgram_model.save(f"trained/embeddings_e{epochs}.vec")
+        if data_proc.rank == 0:
+            skipgram_model.save(f"trained/embeddings_e{epochs}.{args.save_format}")
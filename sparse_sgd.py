@@ -0,0 +1,66 @@
+import torch
+import torch.optim as optimizer
+
+from mixed_precision import stochastic_round
+
+
+class SparseSGD(optimizer.Optimizer):
+    """
+    Plain SGD as in the original word2vec, without any optimizer state.
+    Sparse gradients are applied in-place only to the rows they touch (duplicate rows are accumulated),
+    so the memory footprint stays close to the bare parameters.
+    Learning rate decays linearly with training progress, see decay.
+    With stochastic_rounding, updates of low precision parameters are computed in float32
+    and stochastically rounded back.
+    """
+
+    def __init__(self, params, lr, min_lr_ratio=1e-4, stochastic_rounding=False):
+        super().__init__(params, dict(lr=lr))
+        self.initial_lr = lr
+        self.min_lr_ratio = min_lr_ratio
+        self.stochastic_rounding = stochastic_rounding
+
+    def decay(self, progress):
+        """
+        Sets learning rate to initial_lr * (1 - progress), but at least to initial_lr * min_lr_ratio.
+        :param progress: fraction of the whole training done, from range [0, 1]
+        """
+        lr = self.initial_lr * max(1. - progress, self.min_lr_ratio)
+        for group in self.param_groups:
+            group["lr"] = lr
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        for group in self.param_groups:
+            for p in group["params"]:
+                if p.grad is None:
+                    continue
+                grad = p.grad
+                if self.stochastic_rounding and p.dtype != torch.float32:
+                    self.stochastic_update(p, grad, group["lr"])
+                elif grad.is_sparse:
+                    # index_add_ accumulates duplicate rows, so the gradient does not need to be coalesced
+                    p.index_add_(0, grad._indices()[0], grad._values(), alpha=-group["lr"])
+                else:
+                    p.add_(grad, alpha=-group["lr"])
+        return loss
+
+    @staticmethod
+    def stochastic_update(p, grad, lr):
+        if grad.is_sparse:
+            # Each row has to be rounded once, so duplicate rows are summed first
+            grad = grad.coalesce()
+            rows = grad.indices()[0]
+            p[rows] = stochastic_round(p[rows].float().add_(grad.values().float(), alpha=-lr), p.dtype)
+        else:
+            p.copy_(stochastic_round(p.float().add_(grad.float(), alpha=-lr), p.dtype))
+
+
+OPTIMIZERS = {
+    "sparse_adam": optimizer.SparseAdam,
+    "sgd": SparseSGD
+}
@@ -0,0 +1,91 @@
+"""
+Correctness checks of the training pipeline on a small synthetic corpus, run on CPU with
+
+    python -m pytest test_training.py
+"""
+import os
+
+import numpy as np
+import pytest
+import torch
+
+from benchmark import create_args, generate_corpus
+from embedding_io import load_embeddings
+from skipgram import Skipgram, WordTargetDataProcessor, init_argparser_skipgram
+
+# Relative tolerance of exported low precision vectors to the float32 ones, of the largest float32 value
+EXPORT_TOLERANCE = {"float16": 0.01, "bfloat16": 0.05}
+# Training steps before the export is compared
+EXPORT_STEPS = 100
+
+
+@pytest.fixture(scope="module")
+def corpus_files(tmp_path_factory):
+    return generate_corpus(str(tmp_path_factory.mktemp("corpus")), 2000, seed=0)
+
+
+def create_model(corpus_files, *extra, seed=0):
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    args = create_args(init_argparser_skipgram, *corpus_files, 16, 64, extra=extra)
+    return Skipgram(WordTargetDataProcessor(args, "skipgram"))
+
+
+def train(model, steps):
+    model.dp.init_benchmark()
+    batch_gen = model.dp.create_batch_gen()
+    for _ in range(steps):
+        model.train_step(next(batch_gen))
+
+
+@pytest.mark.parametrize("optimizer,update", [("sgd", "nearest"), ("sgd", "stochastic_rounding"),
+                                              ("sparse_adam", "master_weights")])
+def test_float16_step_is_finite(corpus_files, optimizer, update):
+    model = create_model(corpus_files, "--embedding_dtype", "float16", "--optimizer", optimizer,
+                         "--low_precision_update", update)
+    # V is zero at start, so the second step updates U too
+    train(model, 2)
+    for name, p in model.named_parameters():
+        assert torch.isfinite(p.float()).all(), f"{name} is not finite after float16 {optimizer} {update} step"
+
+
+def test_float16_nearest_rejected_with_sparse_adam(corpus_files):
+    with pytest.raises(ValueError):
+        create_model(corpus_files, "--embedding_dtype", "float16", "--optimizer", "sparse_adam",
+                     "--low_precision_update", "nearest")
+
+
+def test_fused_loss_matches_reference(corpus_files):
+    model = create_model(corpus_files)
+    data_proc = model.dp
+    # V starts at zero, which would make the scores trivial
+    model.v_embeddings.weight.data.normal_(std=0.5)
+    pos_u = torch.randint(data_proc.vocab_size, (data_proc.batch_size,))
+    pos_v = torch.randint(data_proc.vocab_size, (data_proc.batch_size,))
+    neg_v = torch.randint(data_proc.vocab_size, (data_proc.batch_size, data_proc.nsamples))
+    results = []
+    for fused in (False, True):
+        data_proc.fused_loss = fused
+        model.zero_grad()
+        u_emb = model.u_embeddings(pos_u).detach().requires_grad_()
+        loss = model.negative_sampling_loss(u_emb, pos_v, neg_v)
+        loss.backward()
+        results.append((loss.detach(), u_emb.grad, model.v_embeddings.weight.grad.to_dense()))
+    for name, reference, fused in zip(("loss", "U gradient", "V gradient"), *results):
+        assert torch.allclose(reference, fused, rtol=1e-5, atol=1e-7), f"fused {name} differs from the reference"
+
+
+@pytest.mark.parametrize("dtype", list(EXPORT_TOLERANCE))
+def test_low_precision_export_matches_float32(corpus_files, tmp_path, dtype):
+    exported = {}
+    for embedding_dtype in ("float32", dtype):
+        # Master weights update is deterministic, so both models train on the same batches
+        model = create_model(corpus_files, "--embedding_dtype", embedding_dtype, "--optimizer", "sgd",
+                             "-lr", "0.025", "--low_precision_update", "master_weights")
+        train(model, EXPORT_STEPS)
+        path = os.path.join(str(tmp_path), f"{embedding_dtype}.vec")
+        model.save(path)
+        exported[embedding_dtype] = load_embeddings(path)
+    (reference_words, reference), (words, vectors) = exported["float32"], exported[dtype]
+    assert words == reference_words
+    assert np.abs(vectors - reference).max() <= EXPORT_TOLERANCE[dtype] * np.abs(reference).max()
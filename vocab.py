@@ -0,0 +1,63 @@
+import logging
+import multiprocessing
+from collections import Counter
+
+from corpus import corpus_shards, read_word_lists_range
+
+
+def prune_counts(counts, max_size, min_reduce):
+    """
+    Bounds the number of counted words as in original word2vec (ReduceVocab).
+    While counts have more than max_size words, words with min_reduce or less occurences are removed
+    and min_reduce is increased.
+    :return: min_reduce to be used for next pruning
+    """
+    while 0 < max_size < len(counts):
+        for w in [w for w, c in counts.items() if c <= min_reduce]:
+            del counts[w]
+        min_reduce += 1
+    return min_reduce
+
+
+def count_words(corpus, start, end, bytes_to_read=1 << 20, max_size=0):
+    """
+    Counts words in byte range [start, end) of the corpus.
+    :param max_size: maximum number of distinct words kept during counting, 0 for no limit
+    """
+    counts = Counter()
+    min_reduce = 1
+    for wlist, _ in read_word_lists_range(corpus, start, end, bytes_to_read=bytes_to_read):
+        counts.update(wlist)
+        min_reduce = prune_counts(counts, max_size, min_reduce)
+    return counts
+
+
+def _count_shard(args):
+    return count_words(*args)
+
+
+def build_frequency_vocab(corpus, workers=1, bytes_to_read=1 << 20, max_size=0):
+    """
+    Counts words of the corpus in parallel, each worker process counts its own byte range of the corpus
+    and the counts are merged afterwards.
+    :param max_size: maximum number of distinct words kept during counting and merging, 0 for no limit.
+                     Counts of rare words are approximate when pruning takes place.
+    :return: frequency vocabulary ordered by decreasing frequency
+    """
+    shards = [(corpus, start, end, bytes_to_read, max_size) for start, end in corpus_shards(corpus, workers)]
+    counts = Counter()
+    min_reduce = 1
+    with multiprocessing.Pool(workers) as pool:
+        for shard_counts in pool.imap_unordered(_count_shard, shards):
+            counts.update(shard_counts)
+            min_reduce = prune_counts(counts, max_size, min_reduce)
+    return dict(counts.most_common())
+
+
+def write_frequency_vocab(vocab, path):
+    """
+    Writes vocabulary in format read by nlpfit's read_frequency_vocab, one `word frequency` pair per line.
+    """
+    with open(path, "w", encoding="utf-8") as f:
+        f.writelines(f"{w} {c}\n" for w, c in vocab.items())
+    logging.info(f"Vocabulary of {len(vocab)} words saved to {path}")
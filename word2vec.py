@@ -8,13 +8,29 @@ import numpy as np
 import torch
 import torch.nn as nn
 import visdom
-import torch.nn.functional as F
-import torch.optim as optimizer
 from nlpfit.other.logging_config import setup_logging
 
+from nlpfit.preprocessing.nlp_io import read_word_lists
 from nlpfit.preprocessing.tools import read_frequency_vocab
 from tensorboardX import SummaryWriter
 from evaluation.analogy_questions.analogy_questions import read_analogies, eval_analogy_questions
+from evaluation.intrinstric_evaluation.wordsim.wordsim import CompiledWordsim
+from corpus import read_word_lists_range, word_start_offset, corpus_shards, vocab_checksum, write_compiled_corpus, CompiledCorpus
+from prefetch import BatchPrefetcher
+from negative_sampling import NEGATIVE_SAMPLERS
+from vocab import build_frequency_vocab, write_frequency_vocab
+from phrases import build_phrase_corpus, is_phrase_corpus, phrase_corpus_path
+from sgns_loss import sgns_loss
+from sparse_sgd import OPTIMIZERS, SparseSGD
+from mixed_precision import EMBEDDING_DTYPES, MasterWeightsOptimizer
+from hogwild import train_hogwild
+from distributed import SYNC_MODES, init_distributed, broadcast_parameters, all_reduce_gradients, seed_rank, \
+    train_distributed
+from embedding_io import EXPORT_FORMATS, save_embeddings
+from nearest import ExactNearest
+from sharded_embedding import ShardedEmbedding, embedding_blocks, embedding_rows, embedding_matrix
+from metrics import Metrics
+from checkpoint import Checkpointer, load_checkpoint, rng_state, set_rng_state
 
 
 # The wisdom server can be started with command
@@ -24,23 +40,16 @@ from evaluation.analogy_questions.analogy_questions import read_analogies, eval_
 # tensorboard --logdir runs
 
 # TODO
-# Save weights in h5py numpy format instead of .pkl!
-
 # Evaluate solution on extrinstric properties
 # Add evaluation to tensorboard (or visdom?)
-# Phrase clustering
-# Vocabulary parsing
-
-# TODO for optimization
-# Make batch generator to run in parallel (producer-consumer architecture)
-# Precalculate random ints!
-# according to cProfile,
-# <method 'choice' of 'mtrand.RandomState' objects> took 7% of program time
-
 
 # FIXME
 # Using small number of bytes like 50 for file reading results into failure
 
+# Ids of words missing in the vocabulary and of words with less than min_freq occurences
+UNKNOWN_ID = -2
+DISCARDED_ID = -1
+
 class DataProcessor:
 
     def __enter__(self):
@@ -48,18 +57,58 @@ class DataProcessor:
 
     def __init__(self, args, modelname):
         self.modelname = modelname
+        self.distributed = args.distributed
+        if self.distributed and int(args.hogwild_workers):
+            raise ValueError("Hogwild training cannot be combined with distributed training.")
+        # Rank of this process and number of processes in distributed training
+        self.rank, self.world_size = init_distributed() if self.distributed else (0, 1)
+        # Rank 0 prepares phrase corpus, vocabulary and compiled corpus, other ranks wait and reuse them
+        if self.rank > 0:
+            torch.distributed.barrier()
         self.min_freq = int(args.min_freq)
         self.bytes_to_read = args.bytes_to_read
-        self.corpus = args.corpus
+        self.compiled_corpus_path = args.compiled_corpus
         self.vocab_path = args.vocab
+        self.vocab_workers = int(args.vocab_workers)
+        self.vocab_max_size = int(args.vocab_max_size)
+        # Training reads the corpus with merged phrases, if phrase clustering is enabled
+        self.corpus = self.create_phrase_corpus(args) if args.phrase_clustering else args.corpus
+        self.save_vocab_path = args.save_vocab if args.save_vocab else f"{self.corpus}.vocab"
+        if self.rank > 0 and not self.vocab_path:
+            self.vocab_path = self.save_vocab_path
         self.batch_size = int(args.batch_size)
         self.window_size = int(args.window)
         self.threshold = float(args.subsfqwords_tr)
         self.learning_rate = float(args.learning_rate)
+        self.optimizer_type = args.optimizer
+        self.epochs = int(args.epochs)
         self.randints_to_precalculate = int(args.random_ints)
         self.nsamples = int(args.nsamples)
         self.embedding_size = int(args.dimension)
+        self.embedding_dtype = EMBEDDING_DTYPES[args.embedding_dtype]
+        self.low_precision_update = args.low_precision_update
+        self.neg_sampler_type = args.neg_sampler
+        self.fused_loss = args.fused_loss
         self.share_weights = args.shareweights
+        self.embedding_shards = args.embedding_shards.split() if args.embedding_shards else None
+        self.embedding_shard_fractions = [float(f) for f in args.embedding_shard_fractions.split()] \
+            if args.embedding_shard_fractions else None
+        self.hot_rows = int(args.hot_rows)
+
+        # Byte range of the corpus read by the batch generator, None reads the whole corpus
+        self.corpus_range = None
+        # Offset the whole corpus is read from, set when resuming from the middle of an epoch
+        self.start_offset = 0
+        # Reduced windows buffer (rchoices, rchoices_pos) restored from checkpoint
+        self.restored_windows = None
+        self.checkpoint_path = args.checkpoint
+        self.checkpoint_step = int(args.checkpoint_step)
+        self.prefetch_workers = int(args.prefetch_workers)
+        self.prefetch_depth = int(args.prefetch_depth)
+        self.prefetch_mode = args.prefetch_mode
+        self.hogwild_workers = int(args.hogwild_workers)
+        self.sync_mode = args.sync_mode
+        self.sync_step = int(args.sync_step)
 
         self.sanitychecklist = args.sanitychecklist.split()
 
@@ -83,7 +132,7 @@ class DataProcessor:
             self.writer = SummaryWriter(comment=f"_{modelname}_training")
 
         # Load corpus vocab, and calculate prerequisities
-        self.frequency_vocab_with_OOV = self.load_vocab() if args.vocab else self.parse_vocab()
+        self.frequency_vocab_with_OOV = self.load_vocab() if self.vocab_path else self.parse_vocab()
         self.corpus_size = self.calc_corpus_size()
         # Precalculate term used in subsampling of frequent words
         self.t_cs = self.threshold * self.corpus_size
@@ -91,60 +140,174 @@ class DataProcessor:
         self.frequency_vocab = self.calc_frequency_vocab()
         self.vocab_size = len(self.frequency_vocab)  # + 1  # +1 For unknown
 
-        self.sample_table = self.init_sample_table()
+        self.neg_sampler = self.init_neg_sampler()
 
         # Create id mapping used for fast U embedding matrix indexing
         self.w2id = self.create_w2id()
         self.id2w = {v: k for k, v in self.w2id.items()}
+        self.word_lookup = self.create_word_lookup()
+        self.keep_probs = self.init_keep_probs()
+        self.unknown_words = 0
+
+        # Corpus pre-tokenized into word ids
+        self.compiled_corpus = self.load_compiled_corpus() if self.compiled_corpus_path else None
+        if self.rank == 0 and self.distributed:
+            torch.distributed.barrier()
 
         # Preload eval analogy questions
+        self.analogy_questions = None
         if args.eval_aq:
             self.eval_data_aq = args.eval_aq
-            self.analogy_questions = read_analogies(file=self.eval_data_aq, w2id=self.w2id)
+            self.analogy_questions, self.analogy_sections = read_analogies(file=self.eval_data_aq, w2id=self.w2id)
 
         self.eval_intrinstric = args.eval_intrinstric
+        # Training steps over all epochs
+        self.total_iterations = 0
+        # Per-stage timers and throughput counters, shared with prefetch threads
+        self.metrics = Metrics()
 
     def init_benchmark(self):
-        self.corpus_fsize = os.path.getsize(self.corpus)
+        self.corpus_fsize = self.compiled_corpus.nbytes if self.compiled_corpus is not None \
+            else os.path.getsize(self.corpus)
         self.batch_iteration = 0
-        self.time_spent_on_validation = 0
+        self.time_waiting_for_data = 0
+        self.time_computing = 0
         self.bytes_read = 0
-        self.benchmarktime = time.time()
+        self.unknown_words = 0
+        self.metrics.reset()
 
-    def log_epoch_progress(self):
-        self.batch_iteration += 1
-        if self.batch_iteration % self.epoch_state_step == 0:
-            t = time.time()
-            p = t - self.benchmarktime - self.time_spent_on_validation
+    def report_throughput(self, iterations=1):
+        """
+        Counts trained iterations, every epoch_state_step iterations logs epoch progress and throughput,
+        and emits metrics record with per-stage times and pairs/tokens per second.
+        """
+        self.batch_iteration += iterations
+        self.total_iterations += iterations
+        self.metrics.count("pairs", iterations * self.batch_size)
+        if self.batch_iteration // self.epoch_state_step != (self.batch_iteration - iterations) // self.epoch_state_step:
+            p = self.metrics.training_seconds()
             # Derive epoch from bytes read
             total_size = self.corpus_fsize * (math.floor(self.bytes_read / self.corpus_fsize) + 1)
+            epoch_state = self.bytes_read / total_size
+            record = self.metrics.emit(model=self.modelname, iteration=self.batch_iteration,
+                                       total_iterations=self.total_iterations, bytes_read=self.bytes_read,
+                                       epoch_state=epoch_state, bytes_per_s=self.bytes_read / p)
+            slowest = ", ".join(f"{stage} {s:.1f} s" for stage, s in self.metrics.slowest_stages())
             logging.info(
-                f"I:{self.batch_iteration} Time: {p/60:.2f} min - epoch state {self.bytes_read/total_size *100:.2f}% ({int(self.bytes_read/p/1e3)} KB/s)")
+                f"I:{self.batch_iteration} Time: {p/60:.2f} min - epoch state {epoch_state *100:.2f}% ({int(self.bytes_read/p/1e3)} KB/s, "
+                f"{int(record['rates'].get('pairs_per_s', 0))} pairs/s, {int(record['rates'].get('tokens_per_s', 0))} tokens/s)"
+                f" - waiting for data {self.time_waiting_for_data:.1f} s, computing {self.time_computing:.1f} s"
+                f" - slowest stages: {slowest}")
 
-    # For fast negative sampling
-    def init_sample_table(self):
-        self.sample_table = []
-        sample_table_size = 1e8
+    def create_word_list_gen(self):
+        """
+        Creates generator of tuples (word list, bytes read), reading corpus_range of the corpus if it is set.
+        Otherwise the corpus is read from start_offset, bytes read are counted from start_offset then.
+        """
+        if self.corpus_range is None and not self.start_offset:
+            return read_word_lists(self.corpus, bytes_to_read=self.bytes_to_read, report_bytesread=True)
+        start, end = self.corpus_range if self.corpus_range is not None \
+            else (self.start_offset, os.path.getsize(self.corpus))
+        return read_word_lists_range(self.corpus, start, end, bytes_to_read=self.bytes_to_read)
 
-        # Create proper uniform distribution raised on 3/4
-        pow_frequency = np.array(list(self.frequency_vocab.values())) ** 0.75
-        normalizer = sum(pow_frequency)
-        normalized_freqs = pow_frequency / normalizer
+    def create_id_list_gen(self):
+        """
+        Creates generator of tuples (int32 array of word ids, bytes read), reading corpus_range of the corpus
+        if it is set. Words with less than min_freq occurences are discarded, frequent words are subsampled.
+        Compiled corpus is used instead of the text corpus, if it is available.
+        Without corpus_range, the corpus is read from start_offset and bytes read include it.
+        """
+        offset = self.start_offset if self.corpus_range is None else 0
+        if self.compiled_corpus is None:
+            for wlist, bytes_read in self.metrics.timed_iter(self.create_word_list_gen(), "corpus_read"):
+                with self.metrics.timed("corpus_read"):
+                    wids = self.words_to_ids(wlist)
+                yield self.counted_subsample(wids), bytes_read + offset
+        else:
+            start, end = self.corpus_range if self.corpus_range is not None else (offset, self.compiled_corpus.nbytes)
+            id_lists = self.compiled_corpus.read_id_lists(start, end, bytes_to_read=self.bytes_to_read)
+            for wids, bytes_read in self.metrics.timed_iter(id_lists, "corpus_read"):
+                yield self.counted_subsample(wids), bytes_read + offset
+
+    def counted_subsample(self, wids):
+        self.metrics.count("tokens", len(wids))
+        with self.metrics.timed("subsampling"):
+            return self.subsample(wids)
+
+    def resume_at(self, offset):
+        """
+        Makes the next epoch read the corpus from byte offset, where reading stopped before.
+        """
+        self.start_offset = offset if self.compiled_corpus is not None else word_start_offset(self.corpus, offset)
 
-        # Calculate how much table cells should each distribution element have
-        table_distribution = np.round(normalized_freqs * sample_table_size)
+    def create_corpus_shards(self, num_shards):
+        """
+        Splits the corpus into num_shards byte ranges, which can be used as corpus_range.
+        """
+        if self.compiled_corpus is None:
+            return corpus_shards(self.corpus, num_shards)
+        return self.compiled_corpus.shards(num_shards)
 
-        # Create vector table, holding number of items with element ID proprotional
-        # to element id's probability in distribution\
+    def load_compiled_corpus(self):
+        """
+        Memory-maps the compiled corpus, the corpus is compiled first if the file does not exist yet.
+        """
+        checksum = vocab_checksum(self.w2id)
+        if not os.path.exists(self.compiled_corpus_path):
+            logging.info(f"Compiling corpus {self.corpus} into {self.compiled_corpus_path}...")
+            id_lists = (self.words_to_ids(wlist) for wlist, _ in self.create_word_list_gen())
+            tokens = write_compiled_corpus(self.compiled_corpus_path, id_lists, self.vocab_size, checksum)
+            logging.info(f"Compiled {tokens} tokens, {self.unknown_words} unknown words were discarded.")
+            self.unknown_words = 0
+        compiled_corpus = CompiledCorpus(self.compiled_corpus_path)
+        if compiled_corpus.vocab_size != self.vocab_size or compiled_corpus.checksum != checksum:
+            raise ValueError(f"Compiled corpus {self.compiled_corpus_path} was created with different vocabulary, "
+                             f"delete it to compile it again.")
+        return compiled_corpus
+
+    def create_prefetched_batch_gen(self):
+        """
+        Creates batch generator running in background workers, if prefetching is enabled.
+        """
+        if self.prefetch_workers > 0:
+            return iter(BatchPrefetcher(self, workers=self.prefetch_workers, depth=self.prefetch_depth,
+                                        mode=self.prefetch_mode))
+        return self.create_batch_gen()
+
+    def batch_to_tensors(self, batch):
+        return tuple(torch.from_numpy(np.ascontiguousarray(a)).long() for a in batch)
+
+    def init_reduced_windows(self):
+        # Windows restored from checkpoint are consumed first
+        if self.restored_windows is not None:
+            self.rchoices, self.rchoices_pos = self.restored_windows
+            self.restored_windows = None
+            return
+        # Precalculate random reduced window sizes in a single draw, they are consumed chunk by chunk
+        self.rchoices = np.random.randint(1, self.window_size + 1, size=self.randints_to_precalculate, dtype=np.int32)
+        self.rchoices_pos = 0
+
+    def draw_reduced_windows(self, n):
+        """Returns int32 array of n reduced window sizes from range [1, window_size]."""
+        windows = np.empty(n, dtype=np.int32)
+        filled = 0
+        while filled < n:
+            if self.rchoices_pos == len(self.rchoices):
+                self.init_reduced_windows()
+            take = min(n - filled, len(self.rchoices) - self.rchoices_pos)
+            windows[filled:filled + take] = self.rchoices[self.rchoices_pos:self.rchoices_pos + take]
+            self.rchoices_pos += take
+            filled += take
+        return windows
 
-        for wid, c in enumerate(table_distribution):
-            self.sample_table += [wid] * int(c)
-        return np.array(self.sample_table)
+    # For fast negative sampling
+    def init_neg_sampler(self):
+        frequencies = list(self.frequency_vocab.values())
+        return NEGATIVE_SAMPLERS[self.neg_sampler_type](frequencies, self.nsamples)
 
     def get_neg_v_neg_sampling(self):
-        neg_v = np.random.choice(
-            self.sample_table, size=(self.batch_size, self.nsamples)).tolist()
-        return neg_v
+        with self.metrics.timed("negative_sampling"):
+            return self.neg_sampler.sample(self.batch_size)
 
     # This formula is not exactly the one from the original paper,
     # but it is inspired from tensorflow/models skipgram implementation.
@@ -152,19 +315,67 @@ class DataProcessor:
     # it's new behavior now adds relation to the corpus size to the formula
     # and also "it works with the large numbers" from frequency vocab
     # Also see my SO question&answer: https://stackoverflow.com/questions/49012064/skip-gram-implementation-in-tensorflow-models-subsampling-of-frequent-words
-    def should_be_subsampled(self, w):
-        f = self.frequency_vocab_with_OOV[w]
-        keep_prob = (np.sqrt(f / self.t_cs) + 1.) * (self.t_cs / f)
-        roll = np.random.uniform()
-        return not keep_prob > roll
+    def init_keep_probs(self):
+        """
+        Precalculates probability of keeping each word from vocabulary, indexed by word id.
+        """
+        f = np.array(list(self.frequency_vocab.values()), dtype=np.float64)
+        with np.errstate(divide="ignore"):
+            keep_probs = (np.sqrt(f / self.t_cs) + 1.) * (self.t_cs / f)
+        # Words which never occur in the corpus (i.e. UNK) are never kept
+        keep_probs[f == 0] = 0.
+        return keep_probs.astype(np.float32)
+
+    def create_word_lookup(self):
+        # Maps words from the corpus vocabulary to their ids, words with less than min_freq occurences
+        # are mapped to DISCARDED_ID
+        lookup = dict.fromkeys(self.frequency_vocab_with_OOV, DISCARDED_ID)
+        lookup.update(self.w2id)
+        return lookup
+
+    def words_to_ids(self, wlist):
+        """
+        Maps list of words to int32 array of word ids.
+        Words with less than min_freq occurences are discarded.
+        Words missing in the vocabulary are discarded and counted in self.unknown_words.
+        """
+        wids = np.fromiter((self.word_lookup.get(w, UNKNOWN_ID) for w in wlist), dtype=np.int32, count=len(wlist))
+        self.unknown_words += int(np.count_nonzero(wids == UNKNOWN_ID))
+        return wids[wids >= 0]
+
+    def subsample(self, wids):
+        """
+        Subsample of Frequent Words, returns new array with kept word ids.
+        """
+        keep = np.random.random_sample(len(wids)) < self.keep_probs[wids]
+        return wids[keep]
 
     def load_vocab(self):
         logging.info("Loading vocabulary...\n")
         return read_frequency_vocab(self.vocab_path, quiet=True)
 
+    def create_phrase_corpus(self, args):
+        """
+        Rewrites the corpus with phrases merged into single words, if it was not done before.
+        :return: path of the rewritten corpus
+        """
+        if args.vocab:
+            raise ValueError("Vocabulary has to be parsed from the corpus with merged phrases, "
+                             "do not pass --vocab together with --phrase_clustering.")
+        params = dict(passes=int(args.phrase_passes), threshold=float(args.phrase_threshold),
+                      min_count=int(args.phrase_min_count))
+        path = args.phrase_corpus if args.phrase_corpus else phrase_corpus_path(args.corpus, **params)
+        if not is_phrase_corpus(path, args.corpus, max_size=self.vocab_max_size, **params):
+            logging.info(f"Detecting phrases of {args.corpus} with {self.vocab_workers} workers...")
+            build_phrase_corpus(args.corpus, path, workers=self.vocab_workers, max_size=self.vocab_max_size, **params)
+        return path
+
     def parse_vocab(self):
-        # TODO: implement
-        pass
+        logging.info(f"Parsing vocabulary from corpus with {self.vocab_workers} workers...")
+        vocab = build_frequency_vocab(self.corpus, workers=self.vocab_workers, max_size=self.vocab_max_size)
+        # Save vocabulary, so it can be reused with --vocab
+        write_frequency_vocab(vocab, self.save_vocab_path)
+        return vocab
 
     def calc_corpus_size(self):
         return sum(self.frequency_vocab_with_OOV.values())
@@ -172,7 +383,9 @@ class DataProcessor:
     def calc_frequency_vocab(self):
         fvocab = dict()
         fvocab['UNK'] = 0
-        for k, v in self.frequency_vocab_with_OOV.items():
+        # Ids follow decreasing frequency, so the most often updated rows are next to each other,
+        # UNK keeps id 0 used for padding
+        for k, v in sorted(self.frequency_vocab_with_OOV.items(), key=lambda kv: -kv[1]):
             if v >= self.min_freq:
                 fvocab[k] = v
         return fvocab
@@ -186,26 +399,31 @@ class DataProcessor:
     def __exit__(self, exc_type, exc_value, traceback):
         if self.tensorboard_enabled:
             self.writer.close()
-
-
-class SuppressBenchmarkTime:
-    def __init__(self, model):
-        self.model = model
-
-    def __enter__(self):
-        self.val_log_start = time.time()
-        return self
-
-    def __exit__(self, exc_type, exc_value, traceback):
-        self.model.dp.time_spent_on_validation += time.time() - self.val_log_start
+        # Memory map of the compiled corpus is closed with the last reference to it
+        self.compiled_corpus = None
+        if self.distributed:
+            torch.distributed.destroy_process_group()
 
 
 class Word2Vec(nn.Module):
-    def __init__(self, data_proc, _optimizer=optimizer.SparseAdam):
+    def __init__(self, data_proc, _optimizer=None):
         super(Word2Vec, self).__init__()
         self.dp = data_proc
 
+        # Move everything on GPU, if possible
+        # Hogwild training runs on CPU only
+        self.use_cuda = torch.cuda.is_available() and not self.dp.hogwild_workers
+        # according to my benchmarks ~10 times faster on GPU 1080Ti with batch 1024
+        # BUT with proper CPU optimization, CPU should be faster (see blog about GenSim)
+
+        if self.dp.embedding_shards and self.dp.hot_rows:
+            raise ValueError("Hot rows are kept in the first shard of sharded embeddings, "
+                             "use embedding_shard_fractions instead.")
         self.create_embedding_matrices()
+        if isinstance(self.v_embeddings, ShardedEmbedding):
+            if self.dp.fused_loss:
+                raise ValueError("Fused loss needs whole V matrix on one device, "
+                                 "it cannot be used with sharded embeddings.")
 
         # NS loss uses sigmoid
         self.logsigmoid = nn.LogSigmoid()
@@ -216,19 +434,27 @@ class Word2Vec(nn.Module):
         # We need to carefully choose optimizer and its parameters to guarantee no global update will be excuted when training.
         # For example, parameters like weight_decay and momentum in torch.optim. SGD require the global calculation
         # on embedding matrix, which is extremely time-consuming.
-        self.optimizer = _optimizer(filter(lambda p: p.requires_grad, self.parameters()),
-                                    lr=self.initial_lr)
-
-        # Move everything on GPU, if possible
-        self.use_cuda = torch.cuda.is_available()
-        # according to my benchmarks ~10 times faster on GPU 1080Ti with batch 1024
-        # BUT with proper CPU optimization, CPU should be faster (see blog about GenSim)
+        if _optimizer is None:
+            _optimizer = OPTIMIZERS[self.dp.optimizer_type]
+        self.optimizer = self.create_optimizer(_optimizer)
 
         if self.use_cuda:
-            self.cuda()
+            # Sharded embeddings stay on devices of their shards
+            if not isinstance(self.u_embeddings, ShardedEmbedding):
+                self.cuda()
+            self.dp.neg_sampler.to(torch.device("cuda"))
+        if self.dp.distributed:
+            broadcast_parameters(self)
 
         if self.dp.tensorboard_enabled:
             self.global_step = 0
+        # Normalized U matrix used by nearest word queries is cached until the next training step
+        self.nearest = ExactNearest()
+        # Wordsim datasets are mapped to word ids once per training run
+        self.wordsim = CompiledWordsim(self.dp.w2id) if self.dp.eval_intrinstric else None
+        # In distributed training, replicas are the same and only rank 0 saves checkpoints
+        self.checkpointer = Checkpointer(self.dp.checkpoint_path) \
+            if self.dp.checkpoint_path and self.dp.rank == 0 else None
         if data_proc.visdom_enabled:
             self.loss_window = data_proc.visdom.line(X=torch.zeros((1,)).cpu(),
                                                      Y=torch.zeros((1)).cpu(),
@@ -245,6 +471,48 @@ class Word2Vec(nn.Module):
         """
         raise NotImplementedError
 
+    def create_embedding(self, mode=None):
+        """
+        Creates sparse vocab_size x embedding_size matrix, sharded by rows over embedding_shards devices if they are set.
+        :param mode: "mean" creates mean EmbeddingBag taking offsets, ordinary Embedding is created by default
+        """
+        if self.dp.embedding_shards:
+            return ShardedEmbedding(self.dp.vocab_size, self.dp.embedding_size, self.dp.embedding_shards,
+                                    fractions=self.dp.embedding_shard_fractions,
+                                    output_device="cuda" if self.use_cuda else "cpu", mode=mode)
+        if self.use_cuda and 0 < self.dp.hot_rows < self.dp.vocab_size:
+            # Ids are ordered by frequency, the most frequent rows are kept on device, the rest in host memory
+            return ShardedEmbedding(self.dp.vocab_size, self.dp.embedding_size, ["cuda", "cpu"],
+                                    fractions=[self.dp.hot_rows, self.dp.vocab_size - self.dp.hot_rows],
+                                    output_device="cuda", mode=mode)
+        if mode == "mean":
+            return nn.EmbeddingBag(self.dp.vocab_size, self.dp.embedding_size, mode="mean", sparse=True)
+        return nn.Embedding(self.dp.vocab_size, self.dp.embedding_size, sparse=True)
+
+    def create_optimizer(self, _optimizer):
+        """
+        Creates optimizer of trainable parameters, low precision embeddings are updated
+        as set by low_precision_update.
+        """
+        params = filter(lambda p: p.requires_grad, self.parameters())
+        if self.dp.hogwild_workers and not issubclass(_optimizer, SparseSGD):
+            # State of i.e. SparseAdam would be created in each worker process and lost at the end of the epoch
+            raise ValueError("Hogwild training is supported with sgd optimizer only, which has no state "
+                             "to share between worker processes.")
+        if self.dp.embedding_dtype == torch.float16 and self.dp.low_precision_update == "nearest" \
+                and not issubclass(_optimizer, SparseSGD):
+            # i.e. eps of SparseAdam rounds to 0 in float16, zero gradients of the first steps then give NaN updates
+            raise ValueError("Rounding to nearest of float16 embeddings is supported with sgd optimizer only, "
+                             "use master_weights update instead.")
+        if self.dp.embedding_dtype == torch.float32 or self.dp.low_precision_update == "nearest":
+            return _optimizer(params, lr=self.initial_lr)
+        if self.dp.low_precision_update == "master_weights":
+            return MasterWeightsOptimizer(params, _optimizer, lr=self.initial_lr)
+        if not issubclass(_optimizer, SparseSGD):
+            raise ValueError("Stochastic rounding of low precision embeddings is supported with sgd optimizer only, "
+                             "use master_weights update instead.")
+        return _optimizer(params, lr=self.initial_lr, stochastic_rounding=True)
+
     def intristric_eval(self):
         """
         Implement evaluation of intrinstric embeddings here
@@ -252,38 +520,190 @@ class Word2Vec(nn.Module):
         """
         raise NotImplementedError
 
+    def negative_sampling_loss(self, u_emb_batch, pos_v, neg_v):
+        """
+        :param u_emb_batch: U embeddings of samples, shape [batch_size, embedding_size]
+        :param pos_v: ids of positive V words, shape [batch_size]
+        :param neg_v: ids of negative V words, shape [batch_size, nsamples]
+        :return: loss averaged over the batch
+        """
+        if self.dp.fused_loss:
+            return sgns_loss(u_emb_batch, self.v_embeddings.weight, pos_v, neg_v, self.dp.batch_size)
+
+        # Low precision embeddings are accumulated in float32
+        u_emb_batch = u_emb_batch.float()
+        v_emb_batch = self.v_embeddings(pos_v).float()
+
+        # o is sigmoid function
+        # NS loss for 1 sample and max objective is
+        ##########################################################
+        # log o(v^T*u) + sum of k samples log o(-negative_v^T *u)#
+        ##########################################################
+        # log o(v^T*u)  = score
+        # sum of k samples log o(-negative_v^T *u) = neg_score
+
+        # Multiply element wise
+        score = torch.mul(u_emb_batch, v_emb_batch)
+        # Sum so we get dot product for each row
+        score = torch.sum(score, dim=1)
+        score = self.logsigmoid(score)
+        v_neg_emb_batch = self.v_embeddings(neg_v).float()
+
+        # v_neg_emb_batch has shape [BATCH_SIZE,NUM_OF_NEG_SAMPLES,EMBEDDING_DIMENSIONALITY]
+        # u_emb_batch has shape [BATCH_SIZE,EMBEDDING_DIMENSIONALITY]
+        neg_score = torch.bmm(v_neg_emb_batch, u_emb_batch.unsqueeze(2))
+        neg_score = self.logsigmoid(-1. * neg_score)
+
+        return -1. * (torch.sum(score) + torch.sum(neg_score)) / self.dp.batch_size
+
     def count_parameters(self):
         return sum(p.numel() for p in self.parameters() if p.requires_grad)
 
     def init_embeddings(self, u_embeddings, v_embeddings):
         # Initialize with 0.5/embedding dimension  uniform distribution
         initrange = 0.5 / self.dp.embedding_size
-        u_embeddings.weight.data.uniform_(-initrange, initrange)
+        # Sharded embeddings have weight of each shard
+        for weight in u_embeddings.parameters():
+            weight.data.uniform_(-initrange, initrange)
         if not self.dp.share_weights:
-            v_embeddings.weight.data.uniform_(0, 0)
+            for weight in v_embeddings.parameters():
+                weight.data.uniform_(0, 0)
+        # Embeddings are initialized in float32 and then stored in embedding_dtype
+        u_embeddings.to(self.dp.embedding_dtype)
+        v_embeddings.to(self.dp.embedding_dtype)
 
     def _train(self, previously_read=0, epoch=0):
-        batch_gen = self.dp.create_batch_gen()
-        iteration = 0
         self.dp.init_benchmark()
-        for batch in batch_gen:
+        # Hit rate of hot rows is reported for each epoch
+        for embedding in (self.u_embeddings, self.v_embeddings):
+            if isinstance(embedding, ShardedEmbedding):
+                embedding.reset_lookups()
+        if self.dp.hogwild_workers > 0:
+            total_read = train_hogwild(self, self.dp.hogwild_workers, previously_read=previously_read, epoch=epoch)
+            self.save_checkpoint(epoch + 1, 0, total_read)
+            return total_read
+        if self.dp.distributed:
+            total_read = train_distributed(self, previously_read=previously_read, epoch=epoch)
+            self.save_checkpoint(epoch + 1, 0, total_read)
+            return total_read
+        batch_gen = self.dp.create_prefetched_batch_gen()
+        iteration = 0
+        metrics = self.dp.metrics
+        while True:
+            t = time.time()
+            with metrics.timed("batching"):
+                batch = next(batch_gen, None)
+            self.dp.time_waiting_for_data += time.time() - t
+            if batch is None:
+                break
+            t = time.time()
+            loss = self.train_step(batch, previously_read=previously_read)
+            self.dp.time_computing += time.time() - t
+
+            self.dp.report_throughput()
+            self.validate_and_log_step(epoch, loss, iteration, previously_read=previously_read)
+
+            # Position in the corpus is known only when batches are created in this loop. It is the end of
+            # the last chunk read ahead by the batch generator, so on resume the pairs still buffered
+            # from that chunk (at most one chunk of words) are skipped
+            if self.dp.checkpoint_step > 0 and iteration % self.dp.checkpoint_step == 0 and iteration > 0 \
+                    and self.dp.prefetch_workers == 0:
+                self.save_checkpoint(epoch, self.dp.bytes_read, previously_read)
+
+            iteration += 1
+        self.log_epoch_end(epoch, iteration)
+        self.dp.start_offset = 0
+        total_read = self.dp.bytes_read + previously_read
+        self.save_checkpoint(epoch + 1, 0, total_read)
+        return total_read
+
+    def train_step(self, batch, previously_read=0):
+        """
+        Performs one optimization step on batch.
+        :return: loss of the batch
+        """
+        metrics = self.dp.metrics
+        with metrics.timed("forward"):
             # Zero gradient
             self.optimizer.zero_grad()
             # Do forward pass
             loss = self.forward(batch)
+        with metrics.timed("backward"):
             # Calculate gradients
             loss.backward()
+        if self.dp.distributed and self.dp.sync_mode == "sparse_gradients":
+            with metrics.timed("gradient_exchange"):
+                all_reduce_gradients(self)
+        with metrics.timed("optimizer_step"):
             # Perform optimization step
             self.optimizer.step()
+            self.update_learning_rate(self.dp.bytes_read + previously_read)
+        return loss
 
-            with SuppressBenchmarkTime(self):
-                # Validate results on various metrics
-                self.validate_step(epoch, loss, iteration)
-                # Log/Visualise current learning state
-                self.log_step(epoch, loss, iteration, previously_read=previously_read)
-
-            iteration += 1
-        return self.dp.bytes_read + previously_read
+    def save_checkpoint(self, epoch, bytes_read, previously_read):
+        """
+        Saves checkpoint to continue training from, if checkpointing is enabled.
+        :param epoch: epoch to continue with
+        :param bytes_read: corpus byte offset in the epoch to continue from, mid-epoch it is the read-ahead
+                           position of the batch generator, so resuming from it is approximate
+        :param previously_read: bytes read in all previous epochs
+        """
+        if self.checkpointer is None:
+            return
+        with self.dp.metrics.timed("checkpoint"):
+            self.checkpointer.save({
+                "epoch": epoch,
+                "bytes_read": bytes_read,
+                "previously_read": previously_read,
+                "model": self.state_dict(),
+                "optimizer": self.optimizer.state_dict(),
+                "rng": rng_state(),
+                "windows": (self.dp.rchoices, self.dp.rchoices_pos) if hasattr(self.dp, "rchoices") else None,
+                "global_step": getattr(self, "global_step", 0)
+            })
+
+    def resume(self):
+        """
+        Restores training state from checkpoint.
+        :return: tuple (epoch, bytes read in all previous epochs) to continue training with
+        """
+        state = load_checkpoint(self.dp.checkpoint_path)
+        self.load_state_dict(state["model"])
+        self.optimizer.load_state_dict(state["optimizer"])
+        set_rng_state(state["rng"])
+        if self.dp.distributed:
+            # Random state was saved by rank 0 only
+            seed_rank()
+        if self.dp.tensorboard_enabled:
+            self.global_step = state["global_step"]
+        if state["bytes_read"]:
+            self.dp.restored_windows = state["windows"]
+            self.dp.resume_at(state["bytes_read"])
+        logging.info(f"Resuming from checkpoint {self.dp.checkpoint_path}, epoch {state['epoch']}, "
+                     f"byte {state['bytes_read']}")
+        return state["epoch"], state["previously_read"]
+
+    def update_learning_rate(self, bytes_read):
+        """
+        Decays learning rate of SparseSGD linearly with bytes read over total corpus bytes x epochs.
+        """
+        if hasattr(self.optimizer, "decay"):
+            self.optimizer.decay(bytes_read / (self.dp.corpus_fsize * self.dp.epochs))
+
+    def validate_and_log_step(self, epoch, loss, iteration, previously_read=0):
+        # Validate results on various metrics
+        self.validate_step(epoch, loss, iteration)
+        # Log/Visualise current learning state
+        self.log_step(epoch, loss, iteration, previously_read=previously_read)
+
+    def log_epoch_end(self, epoch, iterations):
+        logging.info(f"Epoch {epoch} finished in {iterations} iterations, "
+                     f"waiting for data {self.dp.time_waiting_for_data:.1f} s, computing {self.dp.time_computing:.1f} s")
+        if self.dp.unknown_words:
+            logging.error(f"Encountered {self.dp.unknown_words} unknown words! Are you using the right vocabulary?")
+        if self.dp.hot_rows and isinstance(self.u_embeddings, ShardedEmbedding):
+            logging.info(f"Hot rows on device served {self.u_embeddings.hit_rate():.1%} of U lookups "
+                         f"and {self.v_embeddings.hit_rate():.1%} of V lookups in epoch {epoch}")
 
     def validate_step(self, epoch, loss, iteration):
 
@@ -291,20 +711,22 @@ class Word2Vec(nn.Module):
             logging.info(f"Epoch {epoch}, Loss: {loss.data}")
 
         # Simple sanity check shows nearest words for
-        # words in self.data_processor.sanitycheck
+        # words in self.dp.sanitychecklist
         if iteration % self.dp.sanity_step == 0:
             if self.dp.sanity_check_enabled:
-                self.run_sanity_check()
+                with self.dp.metrics.timed("sanity_check"):
+                    self.run_sanity_check()
 
         # Evaluate solution on analogy questions task
         if iteration % self.dp.eval_aq_step == 0 and self.dp.eval_aq_step > 0:
             if self.dp.analogy_questions is not None:
-                eval_analogy_questions(data_processor=self.dp,
-                                       embeddings=self.u_embeddings,
-                                       use_cuda=self.use_cuda)
-                eval_analogy_questions(data_processor=self.dp,
-                                       embeddings=self.v_embeddings,
-                                       use_cuda=self.use_cuda)
+                with self.dp.metrics.timed("eval_analogy"):
+                    eval_analogy_questions(data_processor=self.dp,
+                                           embeddings=self.u_embeddings,
+                                           name="U")
+                    eval_analogy_questions(data_processor=self.dp,
+                                           embeddings=self.v_embeddings,
+                                           name="V")
 
         ################################################################################################
         # Evaluate solution for intrinstric word similarity properties on following tasks
@@ -320,7 +742,8 @@ class Word2Vec(nn.Module):
         # - [YP-130](http://citeseerx.ist.psu.edu/viewdoc/download?doi=10.1.1.214.7538&rep=rep1&type=pdf)
         if iteration % self.dp.eval_intrx_step == 0:
             if self.dp.eval_intrinstric:
-                self.intristric_eval()
+                with self.dp.metrics.timed("eval_wordsim"):
+                    self.intristric_eval()
 
         # Evaluate solution on extrinstric properties
         # TODO: Implement
@@ -331,52 +754,56 @@ class Word2Vec(nn.Module):
         logging.info("\nSANITY CHECK")
         logging.info(
             "----------------------------------------------------------------------------------------------------------------------------------")
-        for testword in self.dp.sanitycheck:
-            logging.info(f"Nearest words to '{testword}' are: {', '.join(self.find_nearest(testword))}")
+        for testword, nearest in zip(self.dp.sanitychecklist, self.find_nearest_batch(self.dp.sanitychecklist)):
+            logging.info(f"Nearest words to '{testword}' are: {', '.join(nearest)}")
         logging.info(
             "----------------------------------------------------------------------------------------------------------------------------------")
 
     def log_step(self, epoch, loss, iteration, previously_read=0):
         if iteration % self.dp.visdom_step == 0:
             if self.dp.visdom_enabled:
-                self.dp.visdom.line(
-                    X=(torch.ones((1, 1)).cpu() * (self.dp.bytes_read + previously_read)).squeeze(1),
-                    Y=torch.Tensor([loss.data]).cpu(),
-                    win=self.loss_window,
-                    update='append')
+                with self.dp.metrics.timed("visdom"):
+                    self.dp.visdom.line(
+                        X=(torch.ones((1, 1)).cpu() * (self.dp.bytes_read + previously_read)).squeeze(1),
+                        Y=torch.Tensor([loss.data]).cpu(),
+                        win=self.loss_window,
+                        update='append')
 
         if iteration % self.dp.tensorboard_step == 0 and iteration > 0:
             if self.dp.tensorboard_enabled:
                 tag = f"{self.dp.modelname}_UEMB_Epoch_{epoch}_iter_{iteration}"
                 logging.info(f"Saving U embeddings {tag} for tensorboard...")
-                self.dp.writer.add_embedding(self.u_embeddings.weight,
-                                             metadata=[f"{k}({v})" for k, v in self.dp.frequency_vocab.items()],
-                                             tag=tag,
-                                             global_step=self.global_step)
+                with self.dp.metrics.timed("tensorboard"):
+                    self.dp.writer.add_embedding(embedding_matrix(self.u_embeddings),
+                                                 metadata=[f"{k}({v})" for k, v in self.dp.frequency_vocab.items()],
+                                                 tag=tag,
+                                                 global_step=self.global_step)
                 self.global_step += 1
 
-    def find_nearest(self, word, k=10):
-        nembs = torch.transpose(F.normalize(self.u_embeddings.weight), 0, 1)
-        word_id = torch.LongTensor([self.dp.w2id[word]])
+    def search_nearest(self, embeddings, k):
+        """
+        :return: ids of k nearest U embeddings to each of embeddings, shape [n, k]
+        """
+        return self.nearest.search(embedding_blocks(self.u_embeddings), embeddings, k,
+                                   self.dp.total_iterations)[1].cpu().numpy()
+
+    def find_nearest_batch(self, words, k=10):
+        word_ids = torch.LongTensor([self.dp.w2id[word] for word in words])
         if self.use_cuda:
-            word_id = word_id.cuda()
-        embedding = self.u_embeddings(word_id)
-        dist = torch.matmul(embedding, nembs)
+            word_ids = word_ids.cuda()
+        top_predicted = self.search_nearest(embedding_rows(self.u_embeddings, word_ids), k + 1)
+        # The nearest word is the word itself
+        return [[self.dp.id2w[x] for x in row[1:]] for row in top_predicted.tolist()]
 
-        top_predicted = torch.topk(dist, dim=1, k=k + 1)[1].cpu().numpy().tolist()[0][1:]
-        return list(map(lambda x: self.dp.id2w[x], top_predicted))
+    def find_nearest(self, word, k=10):
+        return self.find_nearest_batch([word], k=k)[0]
 
     def find_nearest_emb(self, embedding, k=10):
-        nembs = torch.transpose(F.normalize(self.u_embeddings.weight), 0, 1)
-        dist = torch.matmul(embedding, nembs)
-
-        top_predicted = torch.topk(dist, dim=1, k=k + 1)[1].cpu().numpy().tolist()[0][1:]
+        top_predicted = self.search_nearest(embedding, k + 1).tolist()[0][1:]
         return list(map(lambda x: self.dp.id2w[x], top_predicted))
 
     def translate_emb(self, embedding):
-        nembs = torch.transpose(F.normalize(self.u_embeddings.weight), 0, 1)
-        dist = torch.matmul(embedding, nembs)
-        id = torch.topk(dist, dim=1, k=1)[1].cpu().numpy().tolist()[0][0]
+        id = self.search_nearest(embedding, 1).tolist()[0][0]
         return self.dp.id2w[id]
 
     # The vec file is a text file that contains the word vectors, one per line for each word in the vocabulary.
@@ -387,26 +814,14 @@ class Word2Vec(nn.Module):
     # the -0.10363 -0.063669 0.032436 -0.040798...
     # of -0.0083724 0.0059414 -0.046618 -0.072735...
     # one 0.32731 0.044409 -0.46484 0.14716...
-    def save(self, vec_path):
-        vocab_size = self.dp.vocab_size
-        is_embedding_bag = type(self.u_embeddings) is nn.EmbeddingBag
-        embedding_dimension = self.dp.embedding_size
-        # Using linux file endings
-        with open(vec_path, 'w') as f:
-            logging.info("Saving .vec file to {}".format(vec_path))
-            f.write("{} {}\n".format(vocab_size, embedding_dimension))
-            for word, id in self.dp.w2id.items():
-                tensor_id = torch.LongTensor([id])
-                if self.use_cuda:
-                    tensor_id = tensor_id.cuda()
-                if is_embedding_bag:
-                    trange = torch.LongTensor(range(len(tensor_id)))
-                    if self.use_cuda:
-                        trange = trange.cuda()
-                    self.u_embeddings(tensor_id, trange).cpu().squeeze(0).detach().numpy()
-                else:
-                    embedding = self.u_embeddings(tensor_id).cpu().squeeze(0).detach().numpy()
-                f.write("{} {}\n".format(word, ' '.join(map(str, embedding))))
+    # Binary word2vec (.bin) and raw .npy matrix with vocabulary sidecar are supported too, see embedding_io.
+    def save(self, vec_path, fmt=None):
+        # Row i of U embeddings (of EmbeddingBag too) is the embedding of word with id i
+        # Rows of sharded embeddings are copied from each shard
+        vectors = embedding_matrix(self.u_embeddings).numpy()
+        words = [self.dp.id2w[i] for i in range(self.dp.vocab_size)]
+        save_embeddings(vec_path, words, vectors, fmt=fmt)
+
 
 def init_logging(args):
     setup_logging(os.path.basename(sys.argv[0]).split(".")[0], logpath=args.logging,
@@ -419,11 +834,25 @@ def init_argparser_general(parser):
     # Obligatory arguments
     parser.add_argument("-c", "--corpus", help="input data corpus", required=True)
     parser.add_argument("--vocab", help="precalculated vocabulary")
+    parser.add_argument("--save_vocab",
+                        help="where to save vocabulary parsed from corpus, when --vocab is not given "
+                             "(default: <corpus>.vocab)")
+    parser.add_argument("--vocab_workers", help="number of processes counting words when parsing vocabulary",
+                        default=os.cpu_count())
+    parser.add_argument("--vocab_max_size",
+                        help="maximum number of distinct words kept while parsing vocabulary, rare words are pruned "
+                             "when it is exceeded, 0 for no limit",
+                        default=0)
+    parser.add_argument("--compiled_corpus",
+                        help="corpus pre-tokenized into binary file of word ids, "
+                             "it is compiled from the input data corpus if it does not exist")
 
     # Optional switch arguments
     parser.add_argument("-v", "--verbose", help="increase the model verbosity", action="store_true")
     parser.add_argument("-pc", "--phrase_clustering",
-                        help="enable phrase clustering as described by Mikolov (i.e. New York becomes New_York)",
+                        help="enable phrase clustering as described by Mikolov (i.e. New York becomes New_York), "
+                             "the corpus is rewritten with merged phrases before the vocabulary is parsed, "
+                             "so --vocab cannot be used with it",
                         action="store_true")
     parser.add_argument("-sc", "--sanity_check", action="store_true")
     parser.add_argument("--tensorboard", help="Visualise training info and embeddings in tensorboard.",
@@ -431,6 +860,9 @@ def init_argparser_general(parser):
     parser.add_argument("--visdom", help="visualize training via visdom library", action="store_true")
     parser.add_argument("-sw", "--shareweights", help="make both embedding matrices have the same shared weights",
                         action="store_true")
+    parser.add_argument("--fused_loss",
+                        help="compute negative sampling loss and its sparse gradients in a single fused function",
+                        action="store_true")
     parser.add_argument("--eval_intrinstric", help="eval embeddings on analogy questions task", action="store_true",
                         default=True)
 
@@ -443,6 +875,15 @@ def init_argparser_general(parser):
                         default=25)
     parser.add_argument("-mf", "--min_freq", help="minimum frequence of occurence for a word",
                         default=5)
+    parser.add_argument("--phrase_corpus",
+                        help="where to write the corpus with merged phrases, it is reused if it was built with "
+                             "the same parameters (default: <corpus>.phrases_p<passes>_t<threshold>_m<min count>)")
+    parser.add_argument("--phrase_passes",
+                        help="number of phrase clustering passes, each pass can join phrases found before",
+                        default=2)
+    parser.add_argument("--phrase_threshold", help="minimal score of a bigram to become a phrase", default=100)
+    parser.add_argument("--phrase_min_count", help="minimal number of occurences of a phrase and of its words",
+                        default=5)
     parser.add_argument("-d", "--dimension", help="size of the embedding dimension",
                         default=300)
     parser.add_argument("-br", "--bytes_to_read", help="how much bytes to read from corpus file per chunk",
@@ -452,6 +893,30 @@ def init_argparser_general(parser):
                         help="how many random ints for window subsampling to precalculate at once",
                         default=1310720  # 5 megabytes of int32s
                         )
+    parser.add_argument("--optimizer",
+                        help="sparse_adam, or plain sparse sgd with linear learning rate decay as in word2vec "
+                             "(use learning rate around 0.025 with sgd)",
+                        choices=list(OPTIMIZERS), default="sparse_adam")
+    parser.add_argument("--embedding_shards",
+                        help="devices to shard embedding matrices over by rows, i.e. 'cuda:0 cuda:1 cpu', "
+                             "for vocabularies not fitting into memory of one device")
+    parser.add_argument("--embedding_shard_fractions",
+                        help="fractions of rows kept by each of embedding_shards, i.e. '0.3 0.3 0.4', "
+                             "rows are split evenly by default")
+    parser.add_argument("--hot_rows",
+                        help="number of rows of the most frequent words kept on device, the rest of embedding "
+                             "matrices is kept in host memory and its looked up rows are copied to device "
+                             "through pinned memory, 0 keeps whole matrices on device",
+                        default=0)
+    parser.add_argument("--embedding_dtype", help="precision in which embedding matrices are stored",
+                        choices=list(EMBEDDING_DTYPES), default="float32")
+    parser.add_argument("--low_precision_update",
+                        help="how float16/bfloat16 embeddings are updated: stochastic rounding (sgd optimizer only), "
+                             "float32 master weights kept by optimizer, or rounding to nearest "
+                             "(sgd optimizer only with float16)",
+                        choices=["stochastic_rounding", "master_weights", "nearest"], default="stochastic_rounding")
+    parser.add_argument("--neg_sampler", help="negative sampler, alias table on host or multinomial on device",
+                        choices=["alias", "multinomial"], default="alias")
     parser.add_argument("-tr", "--subsfqwords_tr", help="subsample frequent words threshold", default=1e-4)
     parser.add_argument("--sanitychecklist",
                         help='list of words for which the nearest word embeddings are found during training, '
@@ -459,3 +924,38 @@ def init_argparser_general(parser):
                         default="dog family king eye")
     parser.add_argument("-l", "--logging", help="external path to save example_logs into",
                         default="logs/")
+    parser.add_argument("--save_format",
+                        help="format of saved embeddings: text .vec, binary word2vec .bin, or .npy matrix with vocabulary",
+                        choices=list(EXPORT_FORMATS), default="vec")
+    parser.add_argument("--checkpoint", help="path of training checkpoint, saved after each epoch and every "
+                                             "checkpoint_step iterations, checkpointing is disabled if not set")
+    parser.add_argument("--checkpoint_step",
+                        help="number of steps after which checkpoint is saved, 0 saves it only after each epoch "
+                             "(mid-epoch checkpoints are saved only without prefetching, Hogwild and distributed "
+                             "training)",
+                        default=50000)
+    parser.add_argument("--resume",
+                        help="continue training from --checkpoint, resuming from mid-epoch checkpoint is approximate, "
+                             "words of the last corpus chunk read before the checkpoint are skipped",
+                        action="store_true")
+    parser.add_argument("-hw", "--hogwild_workers",
+                        help="number of processes training shared CPU model without locking (Hogwild), "
+                             "0 trains in a single process, requires sgd optimizer",
+                        default=0)
+    parser.add_argument("--distributed",
+                        help="train data-parallel in processes started by torchrun, over gloo backend, "
+                             "each process trains on its own part of the corpus",
+                        action="store_true")
+    parser.add_argument("--sync_mode",
+                        help="how distributed replicas are synchronized, sparse_gradients averages sparse gradients "
+                             "in every step, average averages parameters every sync_step steps",
+                        choices=SYNC_MODES, default="sparse_gradients")
+    parser.add_argument("--sync_step", help="number of steps after which parameters are averaged with average sync",
+                        default=100)
+    parser.add_argument("-pw", "--prefetch_workers",
+                        help="number of background workers preparing batches, 0 prepares them in the training loop",
+                        default=0)
+    parser.add_argument("-pd", "--prefetch_depth", help="maximum number of prepared batches waiting for training",
+                        default=32)
+    parser.add_argument("--prefetch_mode", help="run prefetch workers as threads or processes",
+                        choices=["thread", "process"], default="thread")